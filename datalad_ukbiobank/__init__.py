@@ -7,12 +7,30 @@ command_suite = (
             'ukb-init',
             'ukb_init',
         ),
+        (
+            'datalad_ukbiobank.init_bulk',
+            'InitBulk',
+            'ukb-init-bulk',
+            'ukb_init_bulk',
+        ),
         (
             'datalad_ukbiobank.update',
             'Update',
             'ukb-update',
             'ukb_update',
         ),
+        (
+            'datalad_ukbiobank.update_all',
+            'UpdateAll',
+            'ukb-update-all',
+            'ukb_update_all',
+        ),
+        (
+            'datalad_ukbiobank.rebuild',
+            'RebuildLayout',
+            'ukb-rebuild-layout',
+            'ukb_rebuild_layout',
+        ),
     ]
 )
 
@@ -0,0 +1,231 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Content-addressed cache of data record downloads
+
+A cache directory (configured as `datalad.ukbiobank.cache`) can be shared by
+any number of datasets, e.g. on a shared filesystem. Each downloaded file is
+stored once, under its SHA256 checksum in `objects/`. `records/` holds an
+index per data record (`<participant>_<record>.json`) with the name, size,
+and checksum of each file ukbfetch yielded for it.
+
+Files are placed into and out of the cache as reflinks, and are copied if
+the filesystem does not support reflinks. Hardlinks are never used, because
+the annex takes over the downloads, and makes its objects read-only, which
+would then apply to the cached content too. The
+modification time of a record's index is updated whenever the record is
+used, and determines the order of least-recently-used eviction.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    # not on Windows
+    fcntl = None
+
+from datalad_ukbiobank.ingest import CHUNKSIZE
+
+lgr = logging.getLogger('datalad.ukbiobank.cache')
+
+# ioctl request to clone a file's extents (Linux)
+_FICLONE = 0x40049409
+
+
+def get_cached_record(cachedir, record, dest):
+    """Place the cached downloads of a data record into a directory
+
+    The size and checksum of each file are verified before it is placed.
+
+    Parameters
+    ----------
+    cachedir : Path
+    record : str
+      Data record, as '<participant>_<record>'.
+    dest : Path
+      Directory to place the files in.
+
+    Returns
+    -------
+    list or None
+      Names of the placed files, or None if the record is not cached, or its
+      cached content is incomplete or corrupted.
+    """
+    cachedir = Path(cachedir)
+    index = cachedir / 'records' / '{}.json'.format(record)
+    files = _get_verified_files(cachedir, record)
+    if files is None:
+        return None
+    placed = []
+    try:
+        for f in files:
+            placed.append(Path(dest) / f['name'])
+            _copy(_get_object_path(cachedir, f['sha256']), placed[-1])
+    except OSError as e:
+        # evicted concurrently
+        lgr.debug('Cannot place cached content of %s: %s', record, e)
+        for p in placed:
+            if os.path.lexists(str(p)):
+                os.unlink(str(p))
+        return None
+    # mark as recently used
+    try:
+        os.utime(str(index))
+    except OSError:
+        # evicted concurrently, but the content is placed already
+        pass
+    return [f['name'] for f in files]
+
+
+def has_cached_record(cachedir, record):
+    """Return whether the complete and intact downloads of a record are cached
+
+    Parameters
+    ----------
+    cachedir : Path
+    record : str
+      Data record, as '<participant>_<record>'.
+    """
+    return _get_verified_files(Path(cachedir), record) is not None
+
+
+def add_cached_record(cachedir, record, paths):
+    """Add the downloads of a data record to the cache
+
+    Parameters
+    ----------
+    cachedir : Path
+    record : str
+      Data record, as '<participant>_<record>'.
+    paths : list
+      Paths of all files downloaded for the record. They are left in place.
+    """
+    cachedir = Path(cachedir)
+    files = []
+    for path in paths:
+        path = Path(path)
+        digest = _hash_file(path)
+        obj = _get_object_path(cachedir, digest)
+        if not obj.exists():
+            obj.parent.mkdir(parents=True, exist_ok=True)
+            tmppath = obj.with_name('.{}.tmp{}'.format(obj.name, os.getpid()))
+            try:
+                _copy(path, tmppath)
+                # never expose a partial object
+                os.replace(str(tmppath), str(obj))
+            finally:
+                if os.path.lexists(str(tmppath)):
+                    os.unlink(str(tmppath))
+        files.append(dict(
+            name=path.name,
+            size=path.stat().st_size,
+            sha256=digest,
+        ))
+    index = cachedir / 'records' / '{}.json'.format(record)
+    index.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmppath = tempfile.mkstemp(prefix='.', dir=str(index.parent))
+    with os.fdopen(fd, 'w') as f:
+        json.dump(dict(files=files), f)
+    os.replace(tmppath, str(index))
+
+
+def evict(cachedir, maxsize):
+    """Remove least-recently-used records until the cache fits a size
+
+    Content that is no longer referenced by any record is removed.
+
+    Parameters
+    ----------
+    cachedir : Path
+    maxsize : int
+      Maximum total size of the cached content, in bytes.
+    """
+    cachedir = Path(cachedir)
+    records = []
+    for index in (cachedir / 'records').glob('*.json'):
+        try:
+            records.append((
+                index.stat().st_mtime,
+                index,
+                json.loads(index.read_text())['files']))
+        except (OSError, ValueError, KeyError):
+            # vanished, or being written concurrently
+            continue
+    records.sort(key=lambda r: r[0])
+    sizes = {}
+    for _, _, files in records:
+        sizes.update((f['sha256'], f['size']) for f in files)
+    total = sum(sizes.values())
+    while total > maxsize and records:
+        _, index, files = records.pop(0)
+        lgr.debug('Evicting %s from the download cache', index.stem)
+        try:
+            index.unlink()
+        except OSError:
+            # evicted concurrently
+            pass
+        referenced = set(f['sha256'] for _, _, fs in records for f in fs)
+        for f in files:
+            if f['sha256'] in referenced or f['sha256'] not in sizes:
+                continue
+            total -= sizes.pop(f['sha256'])
+            try:
+                _get_object_path(cachedir, f['sha256']).unlink()
+            except OSError:
+                pass
+
+
+def _get_verified_files(cachedir, record):
+    """Return the index entries of a record, if all its content is intact"""
+    index = cachedir / 'records' / '{}.json'.format(record)
+    try:
+        files = json.loads(index.read_text())['files']
+    except (OSError, ValueError, KeyError):
+        return None
+    for f in files:
+        obj = _get_object_path(cachedir, f['sha256'])
+        try:
+            size = obj.stat().st_size
+        except OSError:
+            return None
+        if size != f['size'] or _hash_file(obj) != f['sha256']:
+            lgr.warning('Ignoring corrupted cache content of %s', record)
+            return None
+    return files
+
+
+def _get_object_path(cachedir, digest):
+    return cachedir / 'objects' / digest[:2] / digest
+
+
+def _hash_file(path):
+    hasher = hashlib.sha256()
+    with open(str(path), 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNKSIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def _copy(src, dst):
+    """Copy a file, sharing its extents with a reflink if possible"""
+    with open(str(src), 'rb') as s, open(str(dst), 'wb') as d:
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+                return
+            except OSError:
+                # no reflink support, copy instead
+                pass
+        shutil.copyfileobj(s, d)
@@ -0,0 +1,191 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Parallel, sharded execution of `ukbfetch`
+
+This module is executed, as the `ukbfetch-sharded` command, by
+`ukb-update --jobs`, and is recorded as such in its `datalad run` record. It splits a batch file into per-record shards, runs one
+`ukbfetch` process per shard in a dedicated temporary directory, and moves
+all downloads into the target directory once a shard has completed.
+"""
+
+import argparse
+import logging
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+lgr = logging.getLogger('datalad.ukbiobank.fetch')
+
+
+def read_batchfile(path):
+    """Read a ukbfetch batch file
+
+    Returns
+    -------
+    list
+      (participant, record) tuples, in order of appearance.
+
+    Raises
+    ------
+    ValueError
+      If a line does not hold exactly a participant ID and a record ID.
+    """
+    return parse_batch(Path(path).read_text(), source=path)
+
+
+def parse_batch(text, source='batch file'):
+    """Parse the content of a ukbfetch batch file
+
+    See `read_batchfile()`. `source` names the batch in error messages.
+    """
+    batch = []
+    for i, line in enumerate(text.splitlines(), start=1):
+        fields = line.split()
+        if not fields:
+            continue
+        if len(fields) != 2:
+            raise ValueError(
+                'Invalid line {} in {}, expected a participant ID and a '
+                'data record ID: {!r}'.format(i, source, line))
+        batch.append(tuple(fields))
+    return batch
+
+
+def fetch_batch(batch, name, keyfile, workdir, dest, verbose=False):
+    """Download data records with a single ukbfetch process
+
+    Parameters
+    ----------
+    batch : list
+      (participant, record) tuples.
+    name : str
+      Name of the batch, used for its temporary download directory and
+      ukbfetch's download logs.
+    keyfile : Path
+      Absolute path of the authentication key file.
+    workdir : Path
+      Directory to create the batch's temporary download directory in.
+      ukbfetch's download logs are placed here too.
+    dest : Path
+      Directory to move any downloaded file into, once ukbfetch completed.
+    verbose : bool
+      Run ukbfetch in verbose mode.
+
+    Returns
+    -------
+    (int, list)
+      Exit code of ukbfetch, and the names of all files moved into `dest`.
+    """
+    batch_dir = Path(tempfile.mkdtemp(prefix='{}.'.format(name), dir=workdir))
+    records = tuple('{}_{}'.format(p, r) for p, r in batch)
+    try:
+        (batch_dir / '.ukbbatch').write_text(''.join(
+            '{} {}\n'.format(p, r) for p, r in batch))
+        proc = subprocess.run(
+            ['ukbfetch'] + (['-v'] if verbose else []) + [
+                '-a{}'.format(keyfile),
+                '-b.ukbbatch',
+                # keep the download logs next to, not inside the batch
+                '-o{}'.format(workdir / name)],
+            cwd=str(batch_dir),
+        )
+        fetched = []
+        for fp in sorted(batch_dir.iterdir()):
+            if not fp.name.startswith(records):
+                # the batch file
+                continue
+            # rename is atomic, a file appearing in `dest` is complete
+            fp.replace(dest / fp.name)
+            fetched.append(fp.name)
+        return proc.returncode, fetched
+    finally:
+        shutil.rmtree(str(batch_dir), ignore_errors=True)
+
+
+def fetch_shard(participant, record, keyfile, workdir, dest, verbose=False):
+    """Download a single data record with a dedicated ukbfetch process
+
+    See `fetch_batch()` for the parameters, and return value.
+    """
+    return fetch_batch(
+        [(participant, record)],
+        '{}_{}'.format(participant, record),
+        keyfile, workdir, dest, verbose=verbose)
+
+
+def fetch(batch, keyfile, workdir, dest, jobs=1, verbose=False):
+    """Download all records of a batch with up to `jobs` ukbfetch processes
+
+    Returns
+    -------
+    int
+      Zero if all shards were downloaded successfully, the last non-zero
+      ukbfetch exit code otherwise.
+    """
+    keyfile = Path(keyfile).absolute()
+    workdir = Path(workdir).absolute()
+    dest = Path(dest).absolute()
+    workdir.mkdir(parents=True, exist_ok=True)
+    exitcode = 0
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [
+            pool.submit(fetch_shard, p, r, keyfile, workdir, dest, verbose)
+            for p, r in batch
+        ]
+        for (p, r), f in zip(batch, futures):
+            ret, fetched = f.result()
+            if ret:
+                lgr.error('ukbfetch failed for %s %s (exit code %i)',
+                          p, r, ret)
+                exitcode = ret
+            elif not fetched:
+                lgr.warning('ukbfetch did not yield any file for %s %s',
+                            p, r)
+    return exitcode
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        prog='ukbfetch-sharded',
+        description=__doc__.split('\n', 1)[0])
+    parser.add_argument(
+        '-J', '--jobs', type=int, default=1,
+        help='number of ukbfetch processes to run in parallel')
+    parser.add_argument(
+        '-v', dest='verbose', action='store_true',
+        help='run ukbfetch in verbose mode')
+    parser.add_argument(
+        '-a', dest='keyfile', required=True,
+        help='path to the authentication key file')
+    parser.add_argument(
+        '-b', dest='batchfile', required=True,
+        help='path to the ukbfetch batch file')
+    parser.add_argument(
+        '-o', dest='workdir', required=True,
+        help='directory for per-shard temporary download directories')
+    parser.add_argument(
+        '-d', dest='dest', default='.',
+        help='directory to place all downloads into')
+    args = parser.parse_args(args)
+    logging.basicConfig(level=logging.INFO)
+    return fetch(
+        read_batchfile(args.batchfile),
+        keyfile=args.keyfile,
+        workdir=args.workdir,
+        dest=args.dest,
+        jobs=max(1, args.jobs),
+        verbose=args.verbose,
+    )
+
+
+if __name__ == '__main__':
+    sys.exit(main())
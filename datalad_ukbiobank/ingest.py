@@ -0,0 +1,633 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Ingestion of data record archives into the annex of a dataset
+
+`ingest_archive()` reads each file in an archive exactly once. Its content is
+hashed while it is written straight into the annex object store, without
+any intermediate extraction. It can run in a worker thread, just like
+`ingest_file()` for annexing a single downloaded file.
+`register_archive_content()` then registers all content with the
+`datalad-archives` special remote in one batch.
+
+The list of files in an archive is fully determined by the archive's key.
+It is recorded in a manifest under `.git/datalad/ukb/manifests`, such that
+the content of an archive that has been ingested before can be registered
+again without opening the archive. Files left out by a member filter are
+listed without a key, and require the archive to be ingested again once
+they are selected.
+"""
+
+import codecs
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import stat
+import tempfile
+import threading
+import zipfile
+from fnmatch import fnmatch
+from pathlib import (
+    Path,
+    PurePosixPath,
+)
+
+from datalad.consts import ARCHIVES_SPECIAL_REMOTE
+from datalad.customremotes.base import ensure_datalad_remote
+from datalad.runner import StdOutCapture
+from datalad.support.exceptions import CommandError
+from datalad.support.network import URL
+from datalad.utils import ensure_list
+
+lgr = logging.getLogger('datalad.ukbiobank.ingest')
+
+# git-annex backends we can compute keys for (with or without an 'E'
+# extension suffix)
+_hashers = {
+    'MD5': hashlib.md5,
+    'SHA1': hashlib.sha1,
+    'SHA224': hashlib.sha224,
+    'SHA256': hashlib.sha256,
+    'SHA384': hashlib.sha384,
+    'SHA512': hashlib.sha512,
+    'SHA3_224': hashlib.sha3_224,
+    'SHA3_256': hashlib.sha3_256,
+    'SHA3_384': hashlib.sha3_384,
+    'SHA3_512': hashlib.sha3_512,
+    'BLAKE2B256': lambda: hashlib.blake2b(digest_size=32),
+    'BLAKE2B512': lambda: hashlib.blake2b(digest_size=64),
+    'BLAKE2S256': lambda: hashlib.blake2s(digest_size=32),
+}
+
+# read/write chunk size
+CHUNKSIZE = 1024 * 1024
+
+# serializes moving content into the object store across worker threads
+_objstore_lock = threading.Lock()
+
+
+def get_annex_backend(repo, path):
+    """Determine the git-annex backend to use for a path in a repository
+
+    Raises
+    ------
+    ValueError
+      If the backend is not supported for computing keys.
+    """
+    attr = repo.call_git(
+        ['check-attr', 'annex.backend', '--', path]).strip().split(': ')[-1]
+    backend = attr if attr not in ('unspecified', 'unset', '') \
+        else repo.config.get('annex.backend', 'SHA256E')
+    if _get_hasher(backend) is None:
+        raise ValueError(
+            "Unsupported git-annex backend for archive extraction: {}".format(
+                backend))
+    return backend
+
+
+def _get_hasher(backend):
+    return _hashers.get(backend[:-1] if backend.endswith('E') else backend)
+
+
+def get_key_extension(name, maxlength=4, maxcount=2):
+    """Determine the extension of a key like git-annex does for *E backends
+    """
+    exts = []
+    for ext in reversed(name.split('.')[1:]):
+        if len(ext) > maxlength:
+            break
+        if ext and all(c.isalnum() or not c.isascii() for c in ext):
+            exts.append(ext)
+    return ''.join('.{}'.format(e) for e in reversed(exts[:maxcount]))
+
+
+def make_annex_key(backend, size, digest, name, **kwargs):
+    """Compose a git-annex key
+
+    Parameters
+    ----------
+    backend : str
+    size : int
+      Size of the content in bytes.
+    digest : str
+      Hex digest of the content, computed with the hash function of the
+      backend.
+    name : str
+      File name to determine an extension from for *E backends.
+    **kwargs
+      Passed to `get_key_extension()`.
+    """
+    return '{}-s{}--{}{}'.format(
+        backend,
+        size,
+        digest,
+        get_key_extension(name, **kwargs) if backend.endswith('E') else '',
+    )
+
+
+def get_annex_object_path(key):
+    """Return the path of a key's object, relative to `.git/annex/objects`
+
+    This matches git-annex' 'hashdirmixed' layout used in non-bare
+    repositories.
+    """
+    digest = hashlib.md5(key.encode()).digest()
+    word = digest[0] | digest[1] << 8 | digest[2] << 16 | digest[3] << 24
+    chars = '0123456789zqjxkmvwgpfZQJXKMVWGPF'
+    enc = [chars[(word >> (6 * i)) & 31] for i in range(8)]
+    hashdir = ''.join(enc[i + 1] + enc[i] for i in range(0, 4, 2))
+    return '{}/{}/{}/{}'.format(hashdir[:2], hashdir[2:], key, key)
+
+
+def get_archive_member_path(name):
+    """Normalize the name of an archive member like a ZIP extraction would
+
+    Returns
+    -------
+    str or None
+      Relative POSIX path, or None if the name does not point to a location
+      inside an extraction directory.
+    """
+    parts = [
+        p for p in name.replace('\\', '/').split('/')
+        if p not in ('', '.', '..')
+    ]
+    return '/'.join(parts) if parts else None
+
+
+def get_member_filter(include=None, exclude=None):
+    """Return a predicate selecting archive files by their path
+
+    Parameters
+    ----------
+    include : list, optional
+      Glob patterns. If given, only files matching any of them are
+      selected.
+    exclude : list, optional
+      Glob patterns. Files matching any of them are not selected.
+
+    Returns
+    -------
+    callable or None
+      Called with the POSIX path of a file in an archive, returns whether the
+      file is selected. None if all files are selected.
+    """
+    include = ensure_list(include)
+    exclude = ensure_list(exclude)
+    if not include and not exclude:
+        return None
+
+    def select(path):
+        return (not include or any(fnmatch(path, p) for p in include)) \
+            and not any(fnmatch(path, p) for p in exclude)
+    return select
+
+
+# archive member filters of a dataset without any configuration
+NO_MEMBER_FILTERS = dict(include=[], exclude=[], bids_only=False)
+
+
+def get_member_filters(ds):
+    """Return the archive member filters configured for a dataset
+
+    Returns
+    -------
+    dict
+      Sorted lists of 'include' and 'exclude' glob patterns, and whether
+      only files with a BIDS mapping are extracted ('bids_only').
+    """
+    return dict(
+        include=sorted(ensure_list(ds.config.get(
+            'datalad.ukbiobank.include', get_all=True))),
+        exclude=sorted(ensure_list(ds.config.get(
+            'datalad.ukbiobank.exclude', get_all=True))),
+        bids_only=ds.config.getbool(
+            'datalad.ukbiobank', 'bids-only', default=False),
+    )
+
+
+def store_member_filters(ds, **filters):
+    """Store archive member filters in the committed dataset configuration
+
+    Parameters
+    ----------
+    ds : Dataset
+    **filters
+      Any of the filters reported by `get_member_filters()`. Given filters
+      replace the configured ones.
+    """
+    current = get_member_filters(ds)
+    new = dict(current)
+    for f, value in filters.items():
+        new[f] = bool(value) if f == 'bids_only' \
+            else sorted(ensure_list(value))
+    if new == current:
+        return
+    for f, value in new.items():
+        var = 'datalad.ukbiobank.{}'.format(
+            'bids-only' if f == 'bids_only' else f)
+        if var in ds.config:
+            ds.config.unset(var, scope='branch', reload=False)
+        for v in (['true'] if value is True else value or []):
+            ds.config.add(var, v, scope='branch', reload=False)
+    ds.config.reload()
+    ds.save(
+        path=ds.pathobj / '.datalad' / 'config',
+        message="Configure UKB archive member filters",
+        result_renderer='disabled',
+    )
+
+
+def ingest_archive(archive, objdir, backend, select=None):
+    """Stream all files of a ZIP archive into an annex object store
+
+    Each file is decompressed once, and its annex key is computed while the
+    content is written to a temporary file in the annex. Once complete, the
+    file is moved to the object location of the key. No dataset is needed,
+    and this function is safe to be executed in a worker thread.
+
+    Parameters
+    ----------
+    archive : str
+      Path of the ZIP archive.
+    objdir : Path
+      Path of the annex object store (`.git/annex/objects`).
+    backend : str
+      git-annex backend to compute keys with.
+    select : callable, optional
+      Called with the path of each file, see `get_member_filter()`. Files
+      that are not selected are listed, but not decompressed.
+
+    Returns
+    -------
+    dict
+      With the archive size ('size'), and a list of the files in the archive
+      ('members'), each a dict with the relative POSIX 'path' the file would
+      have in an extraction directory, the content 'size', its 'crc32'
+      checksum, and the annex 'key' (None for files not selected).
+    """
+    objdir = Path(objdir)
+    tmpdir = objdir.parent / 'tmp'
+    tmpdir.mkdir(parents=True, exist_ok=True)
+    hasher_factory = _get_hasher(backend)
+    # later members overwrite earlier ones with the same name, like they
+    # would on extraction
+    members = {}
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            path = get_archive_member_path(info.filename)
+            if info.is_dir() or path is None:
+                continue
+            if select is not None and not select(path):
+                members[path] = dict(
+                    path=path,
+                    size=info.file_size,
+                    crc32=info.CRC,
+                    key=None,
+                )
+                continue
+            hasher = hasher_factory()
+            fd, tmppath = tempfile.mkstemp(prefix='ukb', dir=str(tmpdir))
+            try:
+                with zf.open(info) as src, os.fdopen(fd, 'wb') as dst:
+                    for chunk in iter(lambda: src.read(CHUNKSIZE), b''):
+                        hasher.update(chunk)
+                        dst.write(chunk)
+                key = make_annex_key(
+                    backend, info.file_size, hasher.hexdigest(),
+                    PurePosixPath(path).name)
+                _move_into_objstore(
+                    tmppath, objdir / get_annex_object_path(key))
+            finally:
+                if os.path.lexists(tmppath):
+                    os.unlink(tmppath)
+            members[path] = dict(
+                path=path,
+                size=info.file_size,
+                crc32=info.CRC,
+                key=key,
+            )
+    return dict(
+        size=os.stat(archive).st_size,
+        members=list(members.values()),
+    )
+
+
+def ingest_file(path, objdir, backend):
+    """Move a file into an annex object store
+
+    Parameters
+    ----------
+    path : str
+    objdir : Path
+      Path of the annex object store (`.git/annex/objects`).
+    backend : str
+      git-annex backend to compute the key with.
+
+    Returns
+    -------
+    str
+      Annex key of the file.
+    """
+    hasher = _get_hasher(backend)()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNKSIZE), b''):
+            hasher.update(chunk)
+    key = make_annex_key(
+        backend, os.stat(path).st_size, hasher.hexdigest(),
+        os.path.basename(path))
+    _move_into_objstore(path, Path(objdir) / get_annex_object_path(key))
+    if os.path.lexists(path):
+        # identical content was already present
+        os.unlink(path)
+    return key
+
+
+def get_large_files(repo, files):
+    """Determine which files git-annex would annex, like `git annex add`
+
+    The annex.largefiles setting applies, from the git configuration, or
+    else from the file's git attributes, or else from the git-annex
+    configuration. Without any setting, all files are large. Attributes of
+    all files are looked up with a single git process. Only expressions
+    other than 'anything' and 'nothing' are evaluated per file, with
+    `git annex matchexpression`.
+
+    Parameters
+    ----------
+    repo : AnnexRepo
+    files : dict
+      Paths of the files' content, with the POSIX path of each file in the
+      repository as keys.
+
+    Returns
+    -------
+    set
+      Repository paths of all files to be annexed. Any other file is to be
+      committed to git.
+    """
+    if not files:
+        return set()
+    paths = sorted(files)
+    expr = repo.config.get('annex.largefiles')
+    if expr:
+        exprs = dict.fromkeys(paths, expr)
+    else:
+        # path, attribute, value triplets
+        out = repo._git_runner.run(
+            ['git', 'check-attr', '-z', '--stdin', 'annex.largefiles'],
+            protocol=StdOutCapture,
+            stdin=''.join('{}\0'.format(p) for p in paths).encode(),
+        )['stdout'].split('\0')
+        exprs = {
+            out[i]: out[i + 2] for i in range(0, len(out) - 2, 3)
+            if out[i + 2] not in ('unspecified', 'unset', 'set')
+        }
+        if len(exprs) < len(paths):
+            default = repo.call_annex_oneline(
+                ['config', '--get', 'annex.largefiles'])
+            exprs = {p: exprs.get(p, default) for p in paths}
+    return set(
+        p for p in paths
+        if exprs[p] in ('', 'anything')
+        or exprs[p] != 'nothing'
+        and _match_largefiles(repo, exprs[p], p, files[p]))
+
+
+def _match_largefiles(repo, expr, path, content):
+    args = [
+        'matchexpression', '--largefiles', expr,
+        '--file', path,
+        '--size', str(os.stat(str(content)).st_size),
+    ]
+    if 'mime' in expr:
+        # git-annex cannot look at a file outside the worktree
+        args.extend('--{}={}'.format(k, v)
+                    for k, v in _get_mime_info(content).items())
+    try:
+        repo.call_annex(args)
+        return True
+    except CommandError as e:
+        if e.code == 1:
+            # no match
+            return False
+        lgr.warning(
+            'Cannot evaluate annex.largefiles expression %r for %s, '
+            'annexing it: %s', expr, path, (e.stderr or '').strip())
+        return True
+
+
+def _get_mime_info(path):
+    """Approximate libmagic's mime type and encoding of a file"""
+    with open(str(path), 'rb') as f:
+        head = f.read(CHUNKSIZE)
+    encoding = 'binary'
+    if b'\0' in head:
+        pass
+    elif head.isascii():
+        encoding = 'us-ascii'
+    else:
+        try:
+            # a multi-byte character may be cut at the end of the chunk
+            codecs.getincrementaldecoder('utf-8')().decode(head)
+            encoding = 'utf-8'
+        except UnicodeDecodeError:
+            pass
+    mimetype = mimetypes.guess_type(str(path))[0] or (
+        'application/octet-stream' if encoding == 'binary'
+        else 'text/plain')
+    return dict(mimetype=mimetype, mimeencoding=encoding)
+
+
+def _move_into_objstore(src, objpath):
+    with _objstore_lock:
+        if objpath.exists():
+            # same content was ingested before
+            return
+        objpath.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(src, str(objpath))
+        objpath.chmod(stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        # like git-annex, protect content from accidental deletion
+        objpath.parent.chmod(
+            stat.S_IRUSR | stat.S_IXUSR | stat.S_IRGRP
+            | stat.S_IXGRP | stat.S_IROTH | stat.S_IXOTH)
+
+
+def get_manifest_path(repo, archive_key):
+    """Return the path of the manifest of an archive in a repository"""
+    return repo.dot_git / 'datalad' / 'ukb' / 'manifests' / '{}.json'.format(
+        archive_key)
+
+
+def read_manifest(repo, archive_key):
+    """Read the manifest of an archive
+
+    Returns
+    -------
+    list or None
+      Archive files as reported by `ingest_archive()`, or None if there is
+      no manifest for the archive.
+    """
+    path = get_manifest_path(repo, archive_key)
+    if not path.exists():
+        return None
+    manifest = json.loads(path.read_text())
+    return [dict(zip(manifest['fields'], m)) for m in manifest['members']]
+
+
+def write_manifest(repo, archive_key, members):
+    """Record the list of files in an archive in its manifest
+
+    Parameters
+    ----------
+    repo : AnnexRepo
+    archive_key : str
+    members : list
+      Archive files as reported by `ingest_archive()`.
+    """
+    path = get_manifest_path(repo, archive_key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fields = ('path', 'size', 'crc32', 'key')
+    tmppath = path.with_name('.{}.tmp'.format(path.name))
+    tmppath.write_text(json.dumps(
+        dict(
+            fields=fields,
+            members=[[m[f] for f in fields] for m in members],
+        ),
+        separators=(',', ':')))
+    # never leave a partial manifest behind
+    tmppath.replace(path)
+
+
+def get_archive_member_url(archive_key, path, size):
+    """Compose a URL for a file in an archive for the datalad-archives remote
+    """
+    return str(URL(
+        scheme='dl+archive',
+        path=archive_key,
+        fragment=dict(path=path, size=size)))
+
+
+def register_archive_content(repo, extractions):
+    """Register ingested archive content in a repository
+
+    The availability of all keys via the datalad-archives special remote,
+    and of any key with content in this repository, is recorded in a single
+    batch each.
+
+    Parameters
+    ----------
+    repo : AnnexRepo
+    extractions : list
+      Each item is a tuple with the key of an archive, the path (relative to
+      the repository root) the archive content is placed under, and the list
+      of archive files as reported by `ingest_archive()`.
+
+    Yields
+    ------
+    dict
+      Error result records for any key that could not be registered.
+    """
+    ensure_datalad_remote(
+        repo, remote=ARCHIVES_SPECIAL_REMOTE, autoenable=True)
+    objdir = repo.dot_git / 'annex' / 'objects'
+    paths = {}
+    urls = []
+    for archive_key, dest, members in extractions:
+        for m in members:
+            paths[m['key']] = str(PurePosixPath(dest, m['path']))
+            urls.append((m['key'], get_archive_member_url(
+                archive_key, m['path'], m['size'])))
+
+    # content registered from a manifest need not be around
+    yield from register_present_keys(
+        repo,
+        {k: p for k, p in paths.items()
+         if (objdir / get_annex_object_path(k)).exists()})
+    yield from _annex_batch(
+        repo, ['registerurl'],
+        ['{} {}'.format(k, u) for k, u in urls],
+        paths=paths)
+
+
+def register_present_keys(repo, paths):
+    """Record that content of keys is present in a repository
+
+    Parameters
+    ----------
+    repo : AnnexRepo
+    paths : dict
+      Paths (relative to the repository root) of the keys, only used for
+      error reporting, with the keys as keys.
+
+    Yields
+    ------
+    dict
+      Error result records for any key that could not be registered.
+    """
+    yield from _annex_batch(
+        repo, ['setpresentkey'],
+        ['{} {} 1'.format(k, repo.uuid) for k in sorted(paths)],
+        paths=paths)
+
+
+def _annex_batch(repo, args, lines, paths=None):
+    """Feed lines to a single batch-mode git-annex process
+
+    Yields
+    ------
+    dict
+      Error result records, one for each unsuccessful batch input.
+    """
+    if not lines:
+        return
+    aborted = None
+    try:
+        records = repo._call_annex_records(
+            args + ['--batch'],
+            stdin='{}\n'.format('\n'.join(lines)).encode())
+    except CommandError as e:
+        # a non-zero exit on partial failure still comes with a report
+        records = e.kwargs.get('stdout_json')
+        if not records:
+            raise
+        aborted = (e.stderr or '').strip() or None
+    # git-annex stops at the first unparsable input line, anything from
+    # there on is never reported
+    reported = set(
+        rec['input'][0] for rec in records if rec.get('input'))
+    if reported:
+        for line in lines:
+            if line in reported:
+                continue
+            key = line.split(' ', 1)[0]
+            yield dict(
+                action=args[0],
+                status='error',
+                message=aborted or 'not processed by git-annex {}'.format(
+                    args[0]),
+                key=key,
+                path=str(repo.pathobj / (paths or {}).get(key, '')),
+                type='file',
+            )
+    for rec in records:
+        if rec.get('success', False):
+            continue
+        key = rec.get('key')
+        yield dict(
+            action=rec.get('command', args[0]),
+            status='error',
+            message=rec.get('error-messages') or rec.get('note')
+            or 'git-annex {} failed'.format(args[0]),
+            key=key,
+            path=str(repo.pathobj / (
+                rec.get('file') or (paths or {}).get(key, ''))),
+            type='file',
+        )
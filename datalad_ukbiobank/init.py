@@ -10,15 +10,18 @@
 
 """
 
+import argparse
 import logging
 
 from datalad.interface.base import Interface
 from datalad.interface.base import eval_results
 from datalad.interface.base import build_doc
 from datalad.support.constraints import (
+    EnsureBool,
     EnsureStr,
     EnsureNone,
 )
+from datalad.support.external_versions import external_versions
 from datalad.support.param import Parameter
 from datalad.utils import (
     ensure_list,
@@ -30,12 +33,37 @@ from datalad.distribution.dataset import (
     require_dataset,
 )
 
+from datalad_ukbiobank.ingest import (
+    get_member_filters,
+    store_member_filters,
+)
+from datalad_ukbiobank.plumbing import (
+    MODE_FILE,
+    commit_tree,
+    ensure_local_branch,
+    get_tree,
+    get_tree_entries,
+    hash_blobs,
+    merge_tree,
+    update_branch,
+    write_tree,
+)
+
 
 __docformat__ = 'restructuredtext'
 
 lgr = logging.getLogger('datalad.ukbiobank.init')
 
 
+class _StoreFlag(argparse.Action):
+    """Store True for an option, and False for its --no-* variant"""
+    def __init__(self, option_strings, dest, **kwargs):
+        super().__init__(option_strings, dest, nargs=0, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        setattr(namespace, self.dest, not option_string.startswith('--no-'))
+
+
 @build_doc
 class Init(Interface):
     """Initialize an existing dataset to track a UKBiobank participant
@@ -95,17 +123,55 @@ class Init(Interface):
             action='store_true',
             doc="""additionally maintain an incoming-bids branch with a
             BIDS-like organization."""),
+        bids_only=Parameter(
+            args=('--bids-only', '--no-bids-only'),
+            action=_StoreFlag,
+            doc="""only extract archive files with a BIDS mapping, leaving
+            out anything that would end up in the 'non-bids' directory of a
+            session. Such files are still available from the archives on the
+            incoming branch. Implies --bids. The setting is stored in the
+            dataset configuration (datalad.ukbiobank.bids-only), and is kept
+            by a re-initialization without this option.
+            [CMD: --no-bids-only CMD][PY: False PY] switches it off
+            again.""",
+            constraints=EnsureBool() | EnsureNone()),
+        include=Parameter(
+            args=('--include',),
+            metavar='GLOB',
+            action='append',
+            doc="""only extract archive files whose path (within the archive)
+            matches this pattern into incoming-native. Archives are always
+            kept in full on the incoming branch. Filters are stored in the
+            dataset configuration (datalad.ukbiobank.include). Given
+            --include or --exclude filters replace all filters of a previous
+            initialization, otherwise those are kept.
+            [CMD: This option can be given multiple times. CMD]""",
+            constraints=EnsureStr() | EnsureNone()),
+        exclude=Parameter(
+            args=('--exclude',),
+            metavar='GLOB',
+            action='append',
+            doc="""do not extract archive files whose path (within the
+            archive) matches this pattern into incoming-native, e.g.
+            '*/rfMRI.ica/*'. Filters are stored in the dataset configuration
+            (datalad.ukbiobank.exclude), see --include.
+            [CMD: This option can be given multiple times. CMD]""",
+            constraints=EnsureStr() | EnsureNone()),
     )
     @staticmethod
     @datasetmethod(name='ukb_init')
     @eval_results
     def __call__(participant, records, force=False, bids=False,
-                 dataset=None):
+                 bids_only=None, include=None, exclude=None, dataset=None):
         ds = require_dataset(
             dataset, check_installed=True, purpose='initialization')
 
         participant = ensure_list(participant)[0]
         records = ensure_list(records)
+        # a stored BIDS-only setting is kept, unless given explicitly
+        bids = bids or (
+            get_member_filters(ds)['bids_only'] if bids_only is None
+            else bids_only)
 
         repo = ds.repo
         main_branch = repo.get_active_branch()
@@ -134,53 +200,33 @@ class Init(Interface):
                         'use `force` to reinitialize',
             )
             return
-        if 'incoming' not in incoming_branches:
-            # establish "incoming" branch that will hold pristine UKB downloads
-            repo.call_git(['checkout', '--orphan', 'incoming'])
-        else:
-            repo.call_git(['checkout', 'incoming'])
-
-        # place batch file with download config for ukbfetch in it
-        batchfile = repo.pathobj / '.ukbbatch'
-        batchfile.write_text(
-            '{}\n'.format(
-                '\n'.join(
-                    '{} {}'.format(
-                        participant,
-                        rec)
-                    for rec in records)
-            )
-        )
-        # inherit the standard attributes to ensure uniform behavior
-        # across branches
-        (repo.pathobj / '.gitattributes').write_text(
-            repo.call_git(
-                ['cat-file', '-p', '{}:.gitattributes'.format(main_branch)]))
-        # save to incoming branch, provide path to avoid adding untracked
-        # content
-        ds.save(
-            path=['.ukbbatch', '.gitattributes'],
-            to_git=True,
-            message="Configure UKB data fetch",
-            result_renderer=None,
+        # download config for ukbfetch
+        batch = '{}\n'.format(
+            '\n'.join(
+                '{} {}'.format(
+                    participant,
+                    rec)
+                for rec in records)
         )
-        # establish rest of the branch structure: "incoming-native"
-        # for extracted archive content
-        _add_incoming_branch('incoming-native', incoming_branches, repo, batchfile)
-        if bids:
-            _add_incoming_branch('incoming-bids', incoming_branches, repo, batchfile)
-        # force merge unrelated histories into main branch
-        # we are using an orphan branch such that we know that
-        # `git ls-tree incoming`
-        # will only report download-related content, nothing extracted or
-        # manually modified
-        repo.call_git(['checkout', main_branch])
-        repo.call_git([
-            'merge',
-            '-m', 'Merge incoming',
-            '--allow-unrelated-histories',
-            'incoming-bids' if bids else 'incoming-native',
-        ])
+        if not incoming_branches:
+            _init_branches(repo, main_branch, batch, bids)
+        else:
+            error = _reinit_branches(repo, main_branch, batch, bids)
+            if error:
+                yield dict(
+                    res,
+                    status='error',
+                    message=error,
+                )
+                return
+        # member filters are tracked on the main branch, such that any clone
+        # extracts the same files. a re-initialization only replaces the
+        # filters that are given
+        filters = dict(include=include, exclude=exclude) \
+            if include or exclude else {}
+        if bids_only is not None:
+            filters['bids_only'] = bids_only
+        store_member_filters(ds, **filters)
 
         yield dict(
             res,
@@ -191,24 +237,182 @@ class Init(Interface):
         return
 
 
-def _add_incoming_branch(name, incoming_branches, repo, batchfile):
-    if name not in incoming_branches:
-        repo.call_git(['checkout', '-b', name])
-    else:
-        repo.call_git(['checkout', name])
-        # the only thing that we changed in 'incoming' is the batchfile
-        # which we will wipe out from 'incoming-processed' below.
-        # use -s ours to avoid merge conflicts due to the deleted
-        # file
-        repo.call_git(['merge', 'incoming', '-s', 'ours'])
-    # wipe out batch file to keep download-related info separate
-    if batchfile.exists():
-        repo.call_git_success(['rm', '-f', '.ukbbatch'])
-        repo.commit(
-            files=['.ukbbatch'],
-            msg="Do not leak ukbfetch configuration into dataset content")
+def _init_branches(repo, main_branch, batch, bids):
+    """Establish the incoming* branches of a dataset, and merge them
+
+    All commits are composed with git plumbing, nothing is checked out. The
+    branch skeleton is the same for every participant: it only consists of
+    the standard attributes of the main branch, whose blob is already
+    present. Only the batch file blob, two trees, and three commits are
+    written.
+
+    Parameters
+    ----------
+    repo : AnnexRepo
+    main_branch : str
+      Checked out branch to merge the incoming* branches into.
+    batch : str
+      Content of the ukbfetch batch file.
+    bids : bool
+      Whether to establish an incoming-bids branch.
+    """
+    # inherit the standard attributes to ensure uniform behavior
+    # across branches
+    attributes = get_tree_entries(
+        repo, main_branch, paths=['.gitattributes'])
+    blobs = hash_blobs(repo, [batch])
+    # "incoming" is an orphan branch that holds pristine UKB downloads, with
+    # the batch file committed to git, such that
+    # `git ls-tree incoming`
+    # will only report download-related content, nothing extracted or
+    # manually modified
+    incoming = commit_tree(
+        repo,
+        write_tree(repo, dict(
+            attributes, **{'.ukbbatch': (MODE_FILE, blobs[batch])})),
+        [],
+        "Configure UKB data fetch")
+    # rest of the branch structure: "incoming-native" for extracted archive
+    # content, without the batch file to keep download-related info separate
+    native = commit_tree(
+        repo,
+        write_tree(repo, attributes),
+        [incoming],
+        "Do not leak ukbfetch configuration into dataset content")
+    branches = [('incoming', incoming), ('incoming-native', native)]
+    if bids:
+        # starts out identical to incoming-native
+        branches.append(('incoming-bids', native))
+    for branch, commit in branches:
+        repo.update_ref('refs/heads/{}'.format(branch), commit, '0' * 40)
+    # merge unrelated histories into main branch. The merged tree holds
+    # nothing but the attributes of the main branch, hence the merge does
+    # not change its tree
+    main = repo.get_hexsha(main_branch)
+    merge = commit_tree(
+        repo,
+        get_tree(repo, main),
+        [main, native],
+        'Merge incoming')
+    update_branch(repo, main_branch, merge, main)
+
+
+def _reinit_branches(repo, main_branch, batch, bids):
+    """Update the incoming* branches of an initialized dataset, and merge
+
+    Like `_init_branches()`, all commits are composed with git plumbing.
+    Neither the checked out branch, nor the worktree are switched, which
+    matters for datasets with many files.
+
+    Returns
+    -------
+    str or None
+      Error message, if the incoming* branches could not be merged.
+    """
+    for branch in ('incoming', 'incoming-native', 'incoming-bids'):
+        ensure_local_branch(repo, branch)
+    initial = {
+        b: repo.get_hexsha(b) for b in repo.get_branches()
+        if b in ('incoming', 'incoming-native', 'incoming-bids')
+    }
     # inherit the standard attributes to ensure uniform behavior
     # across branches
-    (repo.pathobj / '.gitattributes').write_text(
-        repo.call_git(['cat-file', '-p', 'incoming:.gitattributes']))
-    repo.save(message='Apply standard Git attributes', paths=['.gitattributes'])
+    attributes = get_tree_entries(
+        repo, main_branch, paths=['.gitattributes'])
+    blobs = hash_blobs(repo, [batch])
+    # place batch file with download config for ukbfetch in "incoming"
+    head = {}
+    head['incoming'] = _commit_files(
+        repo,
+        initial.get('incoming'),
+        dict(attributes, **{'.ukbbatch': (MODE_FILE, blobs[batch])}),
+        "Configure UKB data fetch")
+    # establish rest of the branch structure: "incoming-native"
+    # for extracted archive content
+    for branch, start in (('incoming-native', 'incoming'),
+                          ('incoming-bids', 'incoming-native')):
+        if branch == 'incoming-bids' and not bids:
+            continue
+        commit = initial.get(branch)
+        if commit is None:
+            commit = head[start]
+        elif not repo.is_ancestor(head['incoming'], commit):
+            # the only thing that we changed in 'incoming' is the batchfile
+            # which we will wipe out below. Keep the branch's tree (as with
+            # `-s ours`) to avoid merge conflicts due to the deleted file
+            commit = commit_tree(
+                repo,
+                get_tree(repo, commit),
+                [commit, head['incoming']],
+                "Merge branch 'incoming' into {}".format(branch))
+        # wipe out batch file to keep download-related info separate
+        commit = _commit_files(
+            repo, commit, {},
+            "Do not leak ukbfetch configuration into dataset content",
+            removed=['.ukbbatch'])
+        head[branch] = _commit_files(
+            repo, commit, attributes, 'Apply standard Git attributes')
+    for branch, commit in head.items():
+        if commit != initial.get(branch):
+            update_branch(
+                repo, branch, commit, initial.get(branch, '0' * 40))
+
+    # merge unrelated histories into main branch
+    incoming = head['incoming-bids' if bids else 'incoming-native']
+    main = repo.get_hexsha(main_branch)
+    if repo.is_ancestor(incoming, main):
+        # already merged
+        return None
+    if external_versions['cmd:git'] < '2.38':
+        # cannot merge without a worktree, the merge does not switch
+        # branches though
+        repo.call_git([
+            'merge',
+            '-m', 'Merge incoming',
+            '--allow-unrelated-histories',
+            incoming,
+        ])
+        return None
+    tree = merge_tree(repo, main, incoming)
+    if tree is None:
+        return 'Merging the incoming branches into {} conflicts'.format(
+            main_branch)
+    update_branch(
+        repo,
+        main_branch,
+        commit_tree(repo, tree, [main, incoming], 'Merge incoming'),
+        main)
+    return None
+
+
+def _commit_files(repo, parent, entries, message, removed=()):
+    """Commit changed files on top of a commit, unless nothing changes
+
+    Parameters
+    ----------
+    repo : GitRepo
+    parent : str or None
+      Commit to start from. If None, a root commit is created.
+    entries : dict
+      Files to add or replace, see `get_tree_entries()`.
+    message : str
+    removed : list
+      Paths of files to remove.
+
+    Returns
+    -------
+    str
+      SHA of the new commit, or `parent` if no file changes.
+    """
+    if parent is not None:
+        current = get_tree_entries(
+            repo, parent, paths=list(entries) + list(removed))
+        removed = [p for p in removed if p in current]
+        if not removed and all(
+                current.get(p) == e for p, e in entries.items()):
+            return parent
+    return commit_tree(
+        repo,
+        write_tree(repo, entries, base=parent, removed=removed),
+        [parent] if parent is not None else [],
+        message)
@@ -0,0 +1,254 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""
+
+"""
+
+import logging
+import multiprocessing
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    as_completed,
+)
+
+from datalad.interface.base import Interface
+from datalad.interface.base import eval_results
+from datalad.interface.base import build_doc
+from datalad.support.constraints import (
+    EnsureInt,
+    EnsureRange,
+    EnsureStr,
+    EnsureNone,
+)
+from datalad.support.param import Parameter
+from datalad.utils import Path
+
+from datalad.distribution.dataset import (
+    Dataset,
+    datasetmethod,
+    EnsureDataset,
+    require_dataset,
+)
+
+from datalad_ukbiobank.fetch import parse_batch
+from datalad_ukbiobank.init import Init
+
+
+__docformat__ = 'restructuredtext'
+
+lgr = logging.getLogger('datalad.ukbiobank.init_bulk')
+
+
+@build_doc
+class InitBulk(Interface):
+    """Initialize one dataset per participant listed in a UKB bulk file
+
+    The bulk file is read line by line, and its data records are grouped by
+    participant. For each participant, a subdataset of the given
+    superdataset is created (if needed), and initialized with `ukb-init`.
+    Participants are processed in parallel worker processes, and all new
+    subdatasets are registered in the superdataset with a single save
+    afterwards.
+
+    Participants whose dataset is already initialized with the same data
+    records are skipped.
+
+    Worker processes are forked, where the platform supports it. Elsewhere
+    (e.g. on Windows) they are spawned, and a Python script calling this
+    command must do so under an ``if __name__ == '__main__':`` guard.
+    """
+
+    _examples_ = [
+        dict(
+            text='Initialize participant datasets in the current dataset',
+            code_cmd='datalad ukb-init-bulk -J 8 --bids ukb12345.bulk',
+            code_py='ukb_init_bulk("ukb12345.bulk", jobs=8, bids=True)'),
+    ]
+
+    _params_ = dict(
+        dataset=Parameter(
+            args=("-d", "--dataset"),
+            metavar='DATASET',
+            doc="""specify the superdataset to create the participant
+            datasets in""",
+            constraints=EnsureDataset() | EnsureNone()),
+        bulkfile=Parameter(
+            args=('bulkfile',),
+            metavar='BULKFILE',
+            doc="""path to a UKB bulk file, with a participant ID and a
+            data record identifier on each line""",
+            constraints=EnsureStr()),
+        path=Parameter(
+            args=('--path',),
+            metavar='FORMAT',
+            doc="""path of each participant's dataset, relative to the
+            superdataset. The placeholder '{participant}' is replaced by the
+            participant ID.""",
+            constraints=EnsureStr()),
+        force=Parameter(
+            args=("-f", "--force",),
+            doc="""re-initialize datasets that are already initialized with
+            different data records""",
+            action='store_true'),
+        bids=Parameter(
+            args=('--bids',),
+            action='store_true',
+            doc="""additionally maintain an incoming-bids branch with a
+            BIDS-like organization in each dataset."""),
+        jobs=Parameter(
+            args=('-J', '--jobs'),
+            metavar='N',
+            doc="""initialize up to N participant datasets in parallel""",
+            constraints=EnsureInt() & EnsureRange(min=1) | EnsureNone()),
+    )
+    @staticmethod
+    @datasetmethod(name='ukb_init_bulk')
+    @eval_results
+    def __call__(bulkfile, path='{participant}', force=False, bids=False,
+                 jobs=None, dataset=None):
+        ds = require_dataset(
+            dataset, check_installed=True, purpose='bulk initialization')
+
+        try:
+            participants = read_bulkfile(bulkfile)
+        except ValueError as e:
+            yield dict(
+                action='ukb_init_bulk',
+                path=ds.path,
+                type='dataset',
+                status='error',
+                message=str(e),
+                logger=lgr,
+                refds=ds.path,
+            )
+            return
+        lgr.info('Initializing datasets of %i participant(s)',
+                 len(participants))
+
+        registered = set(
+            sds['path'] for sds in ds.subdatasets(
+                result_renderer='disabled', return_type='generator'))
+        new = []
+        with get_process_pool(jobs) as pool:
+            futures = {
+                pool.submit(
+                    _init_participant,
+                    str(ds.pathobj / path.format(participant=p)),
+                    p, records, force, bids): p
+                for p, records in participants.items()
+            }
+            for f in as_completed(futures):
+                for r in f.result():
+                    if r['action'] == 'ukb_init' and r['status'] == 'ok' \
+                            and r['path'] not in registered:
+                        new.append(r['path'])
+                    yield dict(r, logger=lgr, refds=ds.path)
+
+        if new:
+            # a single save registers all new subdatasets at once
+            yield from ds.save(
+                path=sorted(new),
+                message='Add {} UKB participant dataset(s)'.format(len(new)),
+                return_type='generator',
+                result_renderer='disabled',
+                on_failure='ignore',
+            )
+
+
+def get_process_pool(jobs):
+    """Return a pool of worker processes for per-participant commands
+
+    Workers are forked where possible, such that they need not import the
+    calling script (see the `multiprocessing` docs on start methods).
+
+    Parameters
+    ----------
+    jobs : int or None
+      Number of worker processes, one if None.
+
+    Returns
+    -------
+    ProcessPoolExecutor
+    """
+    method = 'fork' \
+        if 'fork' in multiprocessing.get_all_start_methods() else 'spawn'
+    return ProcessPoolExecutor(
+        max_workers=jobs or 1,
+        mp_context=multiprocessing.get_context(method))
+
+
+def read_bulkfile(path):
+    """Read a UKB bulk file, and group its data records by participant
+
+    Lines have the same format as those of a ukbfetch batch file, see
+    `parse_batch()`.
+
+    Returns
+    -------
+    dict
+      Lists of data record identifiers, in order of appearance, with the
+      participant IDs as keys.
+
+    Raises
+    ------
+    ValueError
+      If a line does not hold exactly a participant ID and a data record ID.
+    """
+    participants = {}
+    for participant, record in parse_batch(
+            Path(path).read_text(), source=str(path)):
+        participants.setdefault(participant, []).append(record)
+    return participants
+
+
+def _init_participant(path, participant, records, force, bids):
+    """Create and initialize a participant's dataset, in a worker process
+
+    The dataset is created standalone, registering it in the superdataset
+    is left to the caller.
+
+    Returns
+    -------
+    list
+      Result records.
+    """
+    res = dict(
+        action='ukb_init',
+        path=path,
+        type='dataset',
+    )
+    sub = Dataset(path)
+    try:
+        if not sub.is_installed():
+            sub.create(result_renderer='disabled')
+        elif 'incoming' in sub.repo.get_branches():
+            batch = sub.repo.call_git(
+                ['cat-file', '-p', 'incoming:.ukbbatch'], read_only=True)
+            if batch.split() == [
+                    f for rec in records for f in (participant, rec)]:
+                return [dict(
+                    res,
+                    status='notneeded',
+                    message='Already initialized with the same records',
+                )]
+        return [
+            {k: v for k, v in r.items() if k != 'logger'}
+            for r in Init.__call__(
+                participant, records, force=force, bids=bids, dataset=sub,
+                result_renderer='disabled',
+                return_type='list',
+                on_failure='ignore',
+            )
+        ]
+    except Exception as e:
+        return [dict(
+            res,
+            status='error',
+            message=('Failed to initialize dataset: %s', str(e)),
+        )]
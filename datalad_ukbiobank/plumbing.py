@@ -0,0 +1,353 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""Construction of branch commits without a worktree
+
+The incoming* branches are built by reading and writing trees with git
+plumbing and a temporary index. Neither the active branch nor the worktree
+is touched, which matters for datasets with many files on slow filesystems.
+
+A tree is represented as a dict mapping the POSIX path of each file,
+relative to the repository root, to a (mode, blob SHA) tuple.
+"""
+
+import logging
+import os
+import tempfile
+from pathlib import PurePosixPath
+
+from datalad.runner import (
+    CommandError,
+    StdOutCapture,
+)
+
+from datalad_ukbiobank.ingest import get_annex_object_path
+
+lgr = logging.getLogger('datalad.ukbiobank.plumbing')
+
+# git file modes
+MODE_FILE = '100644'
+MODE_SYMLINK = '120000'
+
+
+def _call_git_stdin(repo, args, stdin, env=None):
+    return repo._git_runner.run(
+        ['git'] + args,
+        protocol=StdOutCapture,
+        stdin=stdin,
+        env=env,
+    )['stdout']
+
+
+def get_tree_entries(repo, ref, paths=None):
+    """Return all files in the tree of a commit
+
+    Parameters
+    ----------
+    repo : GitRepo
+    ref : str
+    paths : list, optional
+      Limit the report to these files (or directories), relative to the
+      repository root.
+
+    Returns
+    -------
+    dict
+      (mode, blob SHA) tuples, with the file paths as keys.
+    """
+    entries = {}
+    out = repo.call_git(['ls-tree', '-r', '-z', '--full-tree', ref],
+                        files=paths,
+                        read_only=True)
+    for line in out.split('\0'):
+        if not line:
+            continue
+        props, path = line.split('\t', 1)
+        mode, _, sha = props.split(' ')
+        entries[path] = (mode, sha)
+    return entries
+
+
+def get_tree(repo, commit):
+    """Return the SHA of the tree of a commit"""
+    return repo.call_git_oneline(
+        ['rev-parse', '{}^{{tree}}'.format(commit)], read_only=True)
+
+
+def ensure_local_branch(repo, branch):
+    """Create a local branch from a remote one of the same name, if needed"""
+    if branch in repo.get_branches():
+        return
+    for rbranch in repo.get_remote_branches():
+        if rbranch.endswith('/{}'.format(branch)):
+            repo.call_git(['branch', '--track', branch, rbranch])
+            return
+
+
+def get_annex_link(key, path):
+    """Return the target of an annex symlink to a key at a repository path"""
+    return '{}.git/annex/objects/{}'.format(
+        '../' * (len(PurePosixPath(path).parts) - 1),
+        get_annex_object_path(key))
+
+
+def add_annex_links(repo, entries, links):
+    """Add annex symlinks to a tree
+
+    All symlink blobs are written with a single git process.
+
+    Parameters
+    ----------
+    repo : AnnexRepo
+    entries : dict
+      Tree to amend, see `get_tree_entries()`.
+    links : list
+      (key, path) tuples, with POSIX paths relative to the repository root.
+    """
+    targets = {path: get_annex_link(key, path) for key, path in links}
+    blobs = hash_blobs(repo, set(targets.values()))
+    entries.update(
+        (path, (MODE_SYMLINK, blobs[target]))
+        for path, target in targets.items())
+
+
+def move_entries(repo, entries, moves):
+    """Compose a tree from entries of another tree at new paths
+
+    Annex symlinks are pointed to their key again if the depth of their
+    path changes. All blobs are read and written with a single git process
+    each.
+
+    Parameters
+    ----------
+    repo : AnnexRepo
+    entries : dict
+      Source tree, see `get_tree_entries()`.
+    moves : dict
+      Source paths, with the path in the new tree as keys.
+
+    Returns
+    -------
+    dict
+      New tree.
+    """
+    moved = {}
+    relink = {}
+    for path, source in moves.items():
+        mode, sha = entries[source]
+        moved[path] = (mode, sha)
+        if mode == MODE_SYMLINK and \
+                path.count('/') != source.count('/'):
+            relink[path] = sha
+    targets = get_blob_contents(repo, set(relink.values()))
+    links = [
+        (PurePosixPath(targets[sha]).name, path)
+        for path, sha in relink.items()
+        if '.git/annex/objects/' in targets[sha]
+    ]
+    add_annex_links(repo, moved, links)
+    return moved
+
+
+def get_blob_contents(repo, shas):
+    """Read blobs from the object database
+
+    Returns
+    -------
+    dict
+      Blob content, as str, with the blob SHAs as keys.
+    """
+    shas = list(shas)
+    if not shas:
+        return {}
+    out = repo._git_runner.run(
+        ['git', 'cat-file', '--batch'],
+        protocol=StdOutCapture,
+        stdin='{}\n'.format('\n'.join(shas)).encode(),
+        encoding='utf-8',
+    )['stdout'].encode()
+    contents = {}
+    pos = 0
+    for sha in shas:
+        header_end = out.index(b'\n', pos)
+        size = int(out[pos:header_end].split()[2])
+        contents[sha] = out[header_end + 1:header_end + 1 + size].decode()
+        # skip the terminating newline
+        pos = header_end + size + 2
+    return contents
+
+
+def hash_blobs(repo, contents):
+    """Write blobs into the object database
+
+    Parameters
+    ----------
+    repo : GitRepo
+    contents : iterable
+      Content of each blob, as str.
+
+    Returns
+    -------
+    dict
+      Blob SHAs, with the blob content as keys.
+    """
+    contents = list(contents)
+    if not contents:
+        return {}
+    with tempfile.TemporaryDirectory(
+            prefix='blobs', dir=str(repo.dot_git)) as tmpdir:
+        paths = []
+        for i, content in enumerate(contents):
+            path = os.path.join(tmpdir, str(i))
+            with open(path, 'w') as f:
+                f.write(content)
+            paths.append(path)
+        shas = hash_files(repo, paths)
+    return {content: shas[path] for content, path in zip(contents, paths)}
+
+
+def hash_files(repo, paths):
+    """Write the content of files into the object database as blobs
+
+    All files are read with a single git process, without applying any
+    filters.
+
+    Returns
+    -------
+    dict
+      Blob SHAs, with the file paths as keys.
+    """
+    paths = [str(p) for p in paths]
+    if not paths:
+        return {}
+    shas = _call_git_stdin(
+        repo,
+        ['hash-object', '-w', '--no-filters', '--stdin-paths'],
+        '{}\n'.format('\n'.join(paths)).encode(),
+    ).split()
+    return dict(zip(paths, shas))
+
+
+def write_tree(repo, entries, base=None, removed=()):
+    """Write a tree object from a set of entries, using a temporary index
+
+    Parameters
+    ----------
+    repo : GitRepo
+    entries : dict
+      Files of the tree, see `get_tree_entries()`.
+    base : str, optional
+      Tree-ish to start from. `entries` are then added to, or replace the
+      files of this tree, and only need to cover the changes.
+    removed : iterable
+      Paths of files of `base` to remove.
+
+    Returns
+    -------
+    str
+      SHA of the tree.
+    """
+    fd, index = tempfile.mkstemp(prefix='index', dir=str(repo.dot_git))
+    os.close(fd)
+    # git refuses to read an empty file as an index
+    os.unlink(index)
+    env = dict(os.environ, GIT_INDEX_FILE=index)
+    try:
+        if base is not None:
+            repo.call_git(['read-tree', base], env=env)
+        update_index(repo, entries, removed=removed, env=env)
+        return repo.call_git(['write-tree'], env=env).strip()
+    finally:
+        if os.path.exists(index):
+            os.unlink(index)
+
+
+def get_changed_paths(repo, old, new):
+    """Return the paths of all files that differ between two commits
+
+    Added, removed, and modified files are reported, renames are not
+    detected.
+    """
+    out = repo.call_git(
+        ['diff-tree', '-r', '-z', '--no-renames', '--name-only', old, new],
+        read_only=True)
+    return [p for p in out.split('\0') if p]
+
+
+def update_index(repo, entries, removed=(), env=None):
+    """Add, replace, and remove files in the index with a single git process
+
+    Parameters
+    ----------
+    repo : GitRepo
+    entries : dict
+      Files to add or replace, in the same form as a tree.
+    removed : iterable
+      Paths of files to remove.
+    env : dict, optional
+      Environment to run git in, e.g. to select a different index file.
+    """
+    _call_git_stdin(
+        repo,
+        ['update-index', '-z', '--index-info'],
+        b''.join(
+            ['0 {}\t{}\0'.format('0' * 40, path).encode()
+             for path in removed]
+            + ['{} {}\t{}\0'.format(mode, sha, path).encode()
+               for path, (mode, sha) in sorted(entries.items())]),
+        env=env,
+    )
+
+
+def merge_tree(repo, ours, theirs):
+    """Compute the tree of a merge of two commits, without a worktree
+
+    Unrelated histories are merged too. Requires git 2.38 or later.
+
+    Returns
+    -------
+    str or None
+      SHA of the merged tree, or None if the merge has conflicts.
+    """
+    try:
+        out = repo.call_git(
+            ['merge-tree', '--write-tree', '--allow-unrelated-histories',
+             ours, theirs])
+    except CommandError as e:
+        if e.code == 1:
+            # conflicts
+            return None
+        raise
+    return out.split('\n', 1)[0].strip()
+
+
+def commit_tree(repo, tree, parents, message):
+    """Create a commit object
+
+    Returns
+    -------
+    str
+      SHA of the commit.
+    """
+    args = ['commit-tree', tree]
+    for p in parents:
+        args.extend(['-p', p])
+    return _call_git_stdin(
+        repo, args + ['-F', '-'], message.encode()).strip()
+
+
+def update_branch(repo, branch, commit, oldcommit):
+    """Point a branch to a new commit
+
+    Should the branch be checked out, index and worktree are updated to
+    match the new commit first, such that a refused worktree update (e.g.
+    due to local modifications) leaves the branch untouched.
+    """
+    if repo.get_active_branch() == branch:
+        repo.call_git(['read-tree', '-u', '-m', oldcommit, commit])
+    repo.update_ref('refs/heads/{}'.format(branch), commit, oldcommit)
@@ -0,0 +1,168 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""
+
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from datalad.interface.base import Interface
+from datalad.interface.base import eval_results
+from datalad.interface.base import build_doc
+from datalad.support.constraints import (
+    EnsureChoice,
+    EnsureInt,
+    EnsureRange,
+    EnsureNone,
+)
+from datalad.support.param import Parameter
+
+from datalad.distribution.dataset import (
+    datasetmethod,
+    EnsureDataset,
+    require_dataset,
+)
+
+from datalad_ukbiobank.ingest import get_annex_backend
+from datalad_ukbiobank.plumbing import ensure_local_branch
+from datalad_ukbiobank.update import (
+    merge_update,
+    submit_extraction,
+    update_bids_layout,
+    update_native_layout,
+)
+
+
+__docformat__ = 'restructuredtext'
+
+lgr = logging.getLogger('datalad.ukbiobank.rebuild')
+
+
+@build_doc
+class RebuildLayout(Interface):
+    """Re-derive the native and/or BIDS layout from the incoming branch
+
+    Nothing is downloaded, and `ukbfetch` is not needed. This is useful
+    after the BIDS mapping changed. The incoming-native branch is rebuilt
+    from all records of the current state of the incoming branch. Archive
+    content is registered from the manifests written when an archive was
+    first extracted. Only archives without a manifest need their content,
+    and it is obtained if it is not present locally. The incoming-bids
+    branch is then rebuilt from incoming-native by mapping all of its files
+    again.
+    """
+
+    _params_ = dict(
+        dataset=Parameter(
+            args=("-d", "--dataset"),
+            metavar='DATASET',
+            doc="""specify the dataset to rebuild the layout(s) of""",
+            constraints=EnsureDataset() | EnsureNone()),
+        layout=Parameter(
+            args=('--layout',),
+            doc="""which layout to rebuild. 'all' rebuilds the native
+            layout, and the BIDS layout if the dataset maintains one.""",
+            constraints=EnsureChoice('all', 'native', 'bids')),
+        merge=Parameter(
+            args=('--merge',),
+            action='store_true',
+            doc="""merge the rebuilt layout into the active branch. If a BIDS
+            layout is maintained in the dataset (incoming-bids branch) it
+            will be merged into the active branch, the incoming-native branch
+            otherwise."""),
+        jobs=Parameter(
+            args=('-J', '--jobs'),
+            metavar='N',
+            doc="""extract up to N archives without a manifest in
+            parallel.""",
+            constraints=EnsureInt() & EnsureRange(min=1) | EnsureNone()),
+    )
+    @staticmethod
+    @datasetmethod(name='ukb_rebuild_layout')
+    @eval_results
+    def __call__(layout='all', merge=False, jobs=None, dataset=None):
+        ds = require_dataset(
+            dataset, check_installed=True, purpose='layout rebuild')
+        repo = ds.repo
+
+        # prep for yield
+        res = dict(
+            action='ukb_rebuild_layout',
+            path=ds.path,
+            type='dataset',
+            logger=lgr,
+            refds=ds.path,
+        )
+
+        if repo.dirty:
+            yield dict(
+                res,
+                status='error',
+                message="Refuse to operate on dirty dataset",
+            )
+            return
+
+        initial_branch = repo.get_active_branch()
+        for branch in ('incoming', 'incoming-native', 'incoming-bids'):
+            ensure_local_branch(repo, branch)
+        branches = repo.get_branches()
+        if 'incoming' not in branches or 'incoming-native' not in branches:
+            yield dict(
+                res,
+                status='impossible',
+                message='Dataset not initialized, run `ukb-init` first',
+            )
+            return
+        want_bids = 'incoming-bids' in branches
+        if layout == 'bids' and not want_bids:
+            yield dict(
+                res,
+                status='impossible',
+                message='Dataset does not maintain a BIDS layout',
+            )
+            return
+
+        if layout in ('all', 'native'):
+            initial_native = repo.get_hexsha('incoming-native')
+            pool = ThreadPoolExecutor(max_workers=jobs or 1)
+            extract = partial(
+                submit_extraction,
+                pool,
+                repo.dot_git / 'annex' / 'objects',
+                get_annex_backend(repo, '.'))
+            try:
+                yield from update_native_layout(ds, extract, rebuild=True)
+            finally:
+                pool.shutdown()
+            yield _get_branch_result(
+                res, repo, 'incoming-native', initial_native)
+
+        if want_bids and layout in ('all', 'bids'):
+            initial_bids = repo.get_hexsha('incoming-bids')
+            yield from update_bids_layout(ds, rebuild=True)
+            yield _get_branch_result(res, repo, 'incoming-bids', initial_bids)
+
+        if merge:
+            yield from merge_update(ds, initial_branch)
+
+
+def _get_branch_result(res, repo, branch, initial):
+    if repo.get_hexsha(branch) == initial:
+        return dict(
+            res,
+            status='notneeded',
+            message=('%s is up to date', branch),
+        )
+    return dict(
+        res,
+        status='ok',
+        message=('Rebuilt %s', branch),
+    )
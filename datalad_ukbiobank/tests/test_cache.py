@@ -0,0 +1,86 @@
+from unittest.mock import patch
+
+from datalad.tests.utils_pytest import (
+    eq_,
+    with_tempfile,
+)
+from datalad.utils import Path
+
+from datalad_ukbiobank import cache
+from datalad_ukbiobank.cache import (
+    add_cached_record,
+    evict,
+    get_cached_record,
+)
+
+
+@with_tempfile(mkdir=True)
+@with_tempfile(mkdir=True)
+@with_tempfile(mkdir=True)
+def test_cache(cachedir=None, srcdir=None, destdir=None):
+    srcdir = Path(srcdir)
+    destdir = Path(destdir)
+    eq_(get_cached_record(cachedir, '1_20227_2_0', destdir), None)
+    (srcdir / '1_20227_2_0.zip').write_text('zip')
+    (srcdir / '2_20227_2_0.zip').write_text('zip')
+    (srcdir / '1_25748_2_0.txt').write_text('txt')
+    add_cached_record(cachedir, '1_20227_2_0', [srcdir / '1_20227_2_0.zip'])
+    add_cached_record(cachedir, '2_20227_2_0', [srcdir / '2_20227_2_0.zip'])
+    add_cached_record(cachedir, '1_25748_2_0', [srcdir / '1_25748_2_0.txt'])
+    # identical content is stored once
+    eq_(len(list((Path(cachedir) / 'objects').glob('*/*'))), 2)
+    # downloads are left in place
+    eq_((srcdir / '1_20227_2_0.zip').read_text(), 'zip')
+
+    eq_(get_cached_record(cachedir, '2_20227_2_0', destdir),
+        ['2_20227_2_0.zip'])
+    eq_((destdir / '2_20227_2_0.zip').read_text(), 'zip')
+    # the annex takes over placed files, they must not share an inode
+    # with the cached content
+    obj, = [
+        p for p in (Path(cachedir) / 'objects').glob('*/*')
+        if p.read_text() == 'zip']
+    for p in (srcdir / '2_20227_2_0.zip', destdir / '2_20227_2_0.zip'):
+        assert not p.samefile(obj)
+
+    # corrupted content is not used
+    obj, = [
+        p for p in (Path(cachedir) / 'objects').glob('*/*')
+        if p.read_text() == 'txt']
+    obj.unlink()
+    obj.write_text('TXT')
+    eq_(get_cached_record(cachedir, '1_25748_2_0', destdir), None)
+    assert not (destdir / '1_25748_2_0.txt').exists()
+
+    # the least recently used record goes first, content shared with
+    # remaining records is kept
+    (destdir / '2_20227_2_0.zip').unlink()
+    evict(cachedir, 3)
+    eq_(get_cached_record(cachedir, '1_20227_2_0', destdir), None)
+    eq_(get_cached_record(cachedir, '2_20227_2_0', destdir),
+        ['2_20227_2_0.zip'])
+    evict(cachedir, 0)
+    eq_(list((Path(cachedir) / 'objects').glob('*/*')), [])
+
+
+@with_tempfile(mkdir=True)
+@with_tempfile(mkdir=True)
+@with_tempfile(mkdir=True)
+def test_cache_concurrent_eviction(cachedir=None, srcdir=None, destdir=None):
+    srcdir = Path(srcdir)
+    destdir = Path(destdir)
+    paths = [srcdir / '1_20227_2_0.zip', srcdir / '1_20227_2_0.txt']
+    for p in paths:
+        p.write_text(p.name)
+    add_cached_record(cachedir, '1_20227_2_0', paths)
+
+    copy = cache._copy
+
+    def evicting_copy(src, dst):
+        copy(src, dst)
+        # the other object vanishes after the first one was placed
+        evict(cachedir, 0)
+    with patch('datalad_ukbiobank.cache._copy', side_effect=evicting_copy):
+        eq_(get_cached_record(cachedir, '1_20227_2_0', destdir), None)
+    # nothing is left behind
+    eq_(list(destdir.iterdir()), [])
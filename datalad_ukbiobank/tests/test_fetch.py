@@ -0,0 +1,13 @@
+from datalad.tests.utils_pytest import (
+    assert_raises,
+    eq_,
+)
+
+from datalad_ukbiobank.fetch import parse_batch
+
+
+def test_parse_batch():
+    eq_(parse_batch('12345 20227_2_0 \n\n12345\t25748_2_0\r\n'),
+        [('12345', '20227_2_0'), ('12345', '25748_2_0')])
+    assert_raises(ValueError, parse_batch, '12345\n')
+    assert_raises(ValueError, parse_batch, '12345 20227_2_0 extra\n')
@@ -0,0 +1,103 @@
+import zipfile
+
+from datalad.api import create
+from datalad.tests.utils_pytest import (
+    assert_in,
+    eq_,
+    with_tempfile,
+)
+from datalad.utils import Path
+
+from datalad_ukbiobank.ingest import (
+    get_annex_backend,
+    get_annex_object_path,
+    get_archive_member_path,
+    ingest_archive,
+    ingest_file,
+    read_manifest,
+    register_present_keys,
+    write_manifest,
+)
+from datalad_ukbiobank.tests import make_datarecord_zips
+
+ckwa = dict(
+    result_renderer='disabled',
+)
+
+
+@with_tempfile
+@with_tempfile(mkdir=True)
+@with_tempfile(mkdir=True)
+def test_ingest_archive(dspath=None, records=None, extractdir=None):
+    make_datarecord_zips('12345', records)
+    archive = Path(records) / '12345_20227_2_0.zip'
+    # reference extraction
+    with zipfile.ZipFile(str(archive)) as zf:
+        zf.extractall(extractdir)
+    ds = create(dspath, **ckwa)
+    objdir = ds.repo.dot_git / 'annex' / 'objects'
+    backend = get_annex_backend(ds.repo, '.')
+    eq_(backend, 'MD5E')
+    extracted = ingest_archive(str(archive), objdir, backend)
+    eq_(extracted['size'], archive.stat().st_size)
+    eq_(sorted(m['path'] for m in extracted['members']),
+        ['fMRI/rfMRI.ica/.files/fsl.css',
+         'fMRI/rfMRI.ica/design.fsf',
+         'fMRI/rfMRI.ica/images/fsl-bg.jpg',
+         'fMRI/rfMRI.ica/images/fsl-logo-big.jpg',
+         'fMRI/rfMRI.json',
+         'fMRI/rfMRI.nii.gz',
+         'fMRI/rfMRI_SBREF.json',
+         'fMRI/rfMRI_SBREF.nii.gz'])
+    for m in extracted['members']:
+        # keys match what git-annex would compute
+        eq_(m['key'],
+            ds.repo.call_annex(
+                ['calckey', '--backend', backend,
+                 str(Path(extractdir) / m['path'])]).strip())
+        # and so does the location in the object store
+        eq_(get_annex_object_path(m['key']),
+            ds.repo.call_annex(
+                ['examinekey', '--format', '${hashdirmixed}${key}/${key}',
+                 m['key']]))
+        # where the content was placed directly
+        eq_((objdir / get_annex_object_path(m['key'])).read_bytes(),
+            (Path(extractdir) / m['path']).read_bytes())
+    # no leftovers of the streaming
+    eq_(list((objdir.parent / 'tmp').iterdir()), [])
+    # ingesting the same content again is fine
+    eq_(ingest_archive(str(archive), objdir, backend), extracted)
+    # members round-trip through a manifest
+    eq_(read_manifest(ds.repo, 'MD5E-s1--dummy.zip'), None)
+    write_manifest(ds.repo, 'MD5E-s1--dummy.zip', extracted['members'])
+    eq_(read_manifest(ds.repo, 'MD5E-s1--dummy.zip'), extracted['members'])
+
+
+def test_get_archive_member_path():
+    eq_(get_archive_member_path('fMRI/rfMRI.json'), 'fMRI/rfMRI.json')
+    eq_(get_archive_member_path('/abs//../fMRI/./x'), 'abs/fMRI/x')
+    eq_(get_archive_member_path('../..'), None)
+
+
+
+@with_tempfile
+def test_register_present_keys(dspath=None):
+    ds = create(dspath, **ckwa)
+    download = ds.pathobj / '.git' / '12345_25747_2_0.adv'
+    download.write_text('some')
+    key = ingest_file(
+        str(download), ds.repo.dot_git / 'annex' / 'objects',
+        get_annex_backend(ds.repo, '.'))
+    # all keys are registered with a single git-annex process, which
+    # gives up on a malformed key
+    res = list(register_present_keys(
+        ds.repo,
+        {key: '12345_25747_2_0.adv', 'nokey': '12345_25747_3_0.adv'}))
+    # one error, reported for the file it concerns
+    eq_(len(res), 1)
+    eq_(res[0]['status'], 'error')
+    eq_(res[0]['action'], 'setpresentkey')
+    eq_(res[0]['path'], str(ds.pathobj / '12345_25747_3_0.adv'))
+    # the other was registered
+    eq_(ds.repo.get_contentlocation(key).split('/')[-1], key)
+    assert_in(ds.repo.uuid, ds.repo.whereis(key, key=True))
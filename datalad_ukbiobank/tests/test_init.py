@@ -72,3 +72,95 @@ def test_bids(path=None):
         for b in ['git-annex', 'incoming', 'incoming-native',
                   'incoming-bids', DEFAULT_BRANCH])
     )
+
+
+@with_tempfile
+def test_branch_skeleton(path=None):
+    ds = create(path, **ckwa)
+    main = ds.repo.get_hexsha(DEFAULT_BRANCH)
+    (ds.pathobj / 'untracked').write_text('content')
+    ds.ukb_init('12345', ['20249_2_0'], bids=True, **ckwa)
+    repo = ds.repo
+    # nothing was checked out
+    eq_(repo.get_active_branch(), DEFAULT_BRANCH)
+    eq_((ds.pathobj / 'untracked').read_text(), 'content')
+    # same commits as a sequence of checkouts and merges would produce
+    eq_(repo.call_git(['log', '--format=%s', 'incoming']),
+        'Configure UKB data fetch\n')
+    eq_(repo.call_git(['rev-list', '--parents', '-1', 'incoming-native']),
+        '{} {}\n'.format(
+            repo.get_hexsha('incoming-native'),
+            repo.get_hexsha('incoming')))
+    eq_(repo.get_hexsha('incoming-bids'), repo.get_hexsha('incoming-native'))
+    eq_(repo.call_git(['rev-list', '--parents', '-1', DEFAULT_BRANCH]),
+        '{} {} {}\n'.format(
+            repo.get_hexsha(DEFAULT_BRANCH),
+            main,
+            repo.get_hexsha('incoming-bids')))
+    eq_(repo.call_git_oneline(['rev-parse', 'incoming-native:.gitattributes']),
+        repo.call_git_oneline(
+            ['rev-parse', '{}:.gitattributes'.format(DEFAULT_BRANCH)]))
+    # merged cleanly
+    eq_(repo.call_git(['diff', '--name-only', main, DEFAULT_BRANCH]), '')
+    assert_true(repo.call_git(['status', '--porcelain']).strip()
+                == '?? untracked')
+
+
+@with_tempfile
+def test_reinit_keeps_worktree(path=None):
+    ds = create(path, **ckwa)
+    ds.ukb_init('12345', ['20249_2_0'], **ckwa)
+    (ds.pathobj / 'content').write_text('content')
+    ds.save(**ckwa)
+    mtime = (ds.pathobj / 'content').stat().st_mtime_ns
+    native = ds.repo.get_hexsha('incoming-native')
+
+    ds.ukb_init('12345', ['20250_2_0'], bids=True, force=True, **ckwa)
+    repo = ds.repo
+    # nothing was checked out
+    eq_(repo.get_active_branch(), DEFAULT_BRANCH)
+    eq_((ds.pathobj / 'content').stat().st_mtime_ns, mtime)
+    assert_not_in('ukbbatch', ds.repo.call_git(['ls-tree', DEFAULT_BRANCH]))
+    eq_(repo.call_git(['cat-file', '-p', 'incoming:.ukbbatch']),
+        '12345 20250_2_0\n')
+    eq_(repo.call_git(['log', '--format=%s', 'incoming']),
+        'Configure UKB data fetch\nConfigure UKB data fetch\n')
+    # incoming-native merged the updated incoming, and keeps its tree
+    eq_(repo.call_git(['rev-list', '--parents', '-1', 'incoming-native']),
+        '{} {} {}\n'.format(
+            repo.get_hexsha('incoming-native'),
+            native,
+            repo.get_hexsha('incoming')))
+    eq_(repo.call_git(['diff', '--name-only', native, 'incoming-native']),
+        '')
+    # the new incoming-bids branch starts at incoming-native, and is merged
+    eq_(repo.get_hexsha('incoming-bids'), repo.get_hexsha('incoming-native'))
+    assert_true(repo.is_ancestor('incoming-bids', DEFAULT_BRANCH))
+    assert_true(repo.call_git(['status', '--porcelain']).strip() == '')
+
+    # a repeated re-init has nothing to commit
+    head = repo.get_hexsha(DEFAULT_BRANCH)
+    ds.ukb_init('12345', ['20250_2_0'], bids=True, force=True, **ckwa)
+    eq_(repo.get_hexsha(DEFAULT_BRANCH), head)
+
+
+@with_tempfile
+def test_reinit_keeps_member_filters(path=None):
+    ds = create(path, **ckwa)
+    ds.ukb_init('12345', ['20249_2_0'], exclude=['*/rfMRI.ica/*'],
+                bids_only=True, **ckwa)
+    ds.ukb_init('12345', ['20250_2_0'], force=True, **ckwa)
+    eq_(ds.config.get('datalad.ukbiobank.exclude'), '*/rfMRI.ica/*')
+    eq_(ds.config.getbool('datalad.ukbiobank', 'bids-only'), True)
+    # a stored BIDS-only setting keeps the BIDS branch merged
+    assert_true(ds.repo.is_ancestor('incoming-bids', DEFAULT_BRANCH))
+    # and can be switched off again
+    ds.ukb_init('12345', ['20250_2_0'], bids_only=False, force=True,
+                **ckwa)
+    eq_(ds.config.get('datalad.ukbiobank.bids-only'), None)
+    # given filters replace all previous ones
+    ds.ukb_init('12345', ['20250_2_0'], include=['fMRI/*'], force=True,
+                **ckwa)
+    eq_(ds.config.get('datalad.ukbiobank.include'), 'fMRI/*')
+    eq_(ds.config.get('datalad.ukbiobank.exclude'), None)
+    assert_status('ok', ds.status(**ckwa))
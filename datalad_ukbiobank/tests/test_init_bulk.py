@@ -0,0 +1,61 @@
+from datalad.api import create
+from datalad.tests.utils_pytest import (
+    assert_in_results,
+    assert_result_count,
+    assert_status,
+    eq_,
+    with_tempfile,
+)
+
+ckwa = dict(
+    result_renderer='disabled',
+)
+
+
+@with_tempfile
+def test_init_bulk(dspath=None):
+    ds = create(dspath, **ckwa)
+    bulkfile = ds.pathobj / '.git' / 'ukb.bulk'
+    bulkfile.write_text(
+        '1002532 20227_2_0\n'
+        '1003339 20252_2_0\n'
+        '\n'
+        '1002532 20249_2_0\n')
+    res = ds.ukb_init_bulk(str(bulkfile), path='sub-{participant}', jobs=2,
+                           **ckwa)
+    assert_result_count(res, 2, action='ukb_init', status='ok')
+    assert_in_results(res, action='save', status='ok')
+    eq_(sorted(s['gitmodule_name'] for s in ds.subdatasets(**ckwa)),
+        ['sub-1002532', 'sub-1003339'])
+    sub = ds.pathobj / 'sub-1002532'
+    eq_((sub / '.ukbbatch').exists(), False)
+    eq_(ds.repo.call_git(
+        ['-C', str(sub), 'cat-file', '-p', 'incoming:.ukbbatch']),
+        '1002532 20227_2_0\n1002532 20249_2_0\n')
+    assert_status('ok', ds.status(**ckwa))
+
+    # unchanged participants are left alone, changed ones need force
+    bulkfile.write_text(
+        '1002532 20227_2_0\n'
+        '1002532 20249_2_0\n'
+        '1003339 20252_3_0\n')
+    res = ds.ukb_init_bulk(str(bulkfile), path='sub-{participant}',
+                           on_failure='ignore', **ckwa)
+    assert_in_results(res, action='ukb_init', status='notneeded')
+    assert_in_results(res, action='ukb_init', status='error')
+    res = ds.ukb_init_bulk(str(bulkfile), path='sub-{participant}',
+                           force=True, **ckwa)
+    assert_in_results(res, action='ukb_init', status='ok',
+                      path=str(ds.pathobj / 'sub-1003339'))
+
+
+@with_tempfile
+def test_init_bulk_invalid(dspath=None):
+    ds = create(dspath, **ckwa)
+    bulkfile = ds.pathobj / '.git' / 'ukb.bulk'
+    for content in ('1002532 20227_2_0\n1003339\n',
+                    '1002532 20227_2_0 extra\n'):
+        bulkfile.write_text(content)
+        res = ds.ukb_init_bulk(str(bulkfile), on_failure='ignore', **ckwa)
+        assert_in_results(res, action='ukb_init_bulk', status='error')
+        assert_result_count(res, 0, action='ukb_init')
@@ -0,0 +1,62 @@
+from datalad.api import create
+from datalad.support.exceptions import CommandError
+from datalad.tests.utils_pytest import (
+    assert_raises,
+    eq_,
+    with_tempfile,
+)
+
+from datalad_ukbiobank.plumbing import (
+    MODE_SYMLINK,
+    add_annex_links,
+    commit_tree,
+    get_annex_link,
+    get_tree_entries,
+    update_branch,
+    write_tree,
+)
+
+ckwa = dict(
+    result_renderer='disabled',
+)
+
+
+@with_tempfile
+def test_tree_roundtrip(dspath=None):
+    ds = create(dspath, **ckwa)
+    (ds.pathobj / 'file.txt').write_text('content')
+    ds.save(**ckwa)
+    key = ds.repo.get_file_annexinfo('file.txt')['key']
+    head = ds.repo.get_hexsha()
+    entries = get_tree_entries(ds.repo, head)
+    # an unchanged set of entries yields the same tree
+    eq_(write_tree(ds.repo, entries),
+        ds.repo.call_git_oneline(['rev-parse', 'HEAD^{tree}']))
+
+    eq_(get_annex_link(key, 'sub/dir/f.txt'),
+        '../../.git/annex/objects/{}'.format(
+            ds.repo.call_annex_oneline(
+                ['examinekey', '--format', '${hashdirmixed}${key}/${key}',
+                 key])))
+    add_annex_links(ds.repo, entries, [(key, 'sub/f.txt')])
+    eq_(entries['sub/f.txt'][0], MODE_SYMLINK)
+    commit = commit_tree(
+        ds.repo, write_tree(ds.repo, entries), [head], 'Add link')
+    # the active branch is updated including the worktree
+    update_branch(ds.repo, ds.repo.get_active_branch(), commit, head)
+    eq_(ds.repo.get_hexsha(), commit)
+    eq_((ds.pathobj / 'sub' / 'f.txt').read_text(), 'content')
+    eq_(ds.repo.dirty, False)
+
+
+    # a worktree update that would overwrite an untracked file is refused,
+    # and leaves the branch as it was
+    add_annex_links(ds.repo, entries, [(key, 'other.txt')])
+    blocked = commit_tree(
+        ds.repo, write_tree(ds.repo, entries), [commit], 'Add other link')
+    (ds.pathobj / 'other.txt').write_text('local')
+    assert_raises(
+        CommandError,
+        update_branch, ds.repo, ds.repo.get_active_branch(), blocked, commit)
+    eq_(ds.repo.get_hexsha(), commit)
+    eq_((ds.pathobj / 'other.txt').read_text(), 'local')
@@ -0,0 +1,63 @@
+import os
+from unittest.mock import patch
+
+from datalad.api import create
+from datalad.tests.utils_pytest import (
+    assert_in,
+    assert_in_results,
+    assert_result_count,
+    assert_status,
+    eq_,
+    skip_if_on_windows,
+    with_tempfile,
+)
+from datalad_ukbiobank.tests import (
+    make_datarecord_zips,
+)
+from datalad_ukbiobank.tests.test_update import (
+    ckwa,
+    make_ukbfetch,
+)
+
+
+@skip_if_on_windows  # see gh-61
+@with_tempfile
+@with_tempfile(mkdir=True)
+def test_rebuild_layout(dspath=None, records=None):
+    make_datarecord_zips('12345', records)
+    ds = create(dspath, **ckwa)
+    ds.ukb_init(
+        '12345',
+        ['20227_2_0', '25747_2_0', '25748_2_0', '25748_3_0'],
+        bids=True, **ckwa)
+    ds.config.add('datalad.ukbiobank.keyfile', 'dummy', scope='local')
+    bin_dir = make_ukbfetch(ds, records)
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}):
+        ds.ukb_update(merge=True, **ckwa)
+    native = ds.repo.get_hexsha('incoming-native')
+    bids = ds.repo.get_hexsha('incoming-bids')
+
+    # without any content, and without ukbfetch, nothing changes
+    ds.repo.call_annex(['drop', '--force', '--all'])
+    res = ds.ukb_rebuild_layout(**ckwa)
+    assert_result_count(res, 2, status='notneeded')
+    eq_(ds.repo.get_hexsha('incoming-native'), native)
+    eq_(ds.repo.get_hexsha('incoming-bids'), bids)
+
+    # a damaged BIDS layout is restored from the native one
+    ds.repo.call_git(['checkout', 'incoming-bids'])
+    ds.repo.call_git(
+        ['rm', '-q', 'ses-2/func/sub-12345_ses-2_task-rest_bold.nii.gz'])
+    ds.repo.commit(msg='Damage')
+    ds.repo.call_git(['checkout', '-'])
+    res = ds.ukb_rebuild_layout(layout='bids', merge=True, **ckwa)
+    assert_in_results(
+        res, action='ukb_rebuild_layout', status='ok',
+        message=('Rebuilt %s', 'incoming-bids'))
+    assert_in_results(res, action='ukb_merge_update', status='ok')
+    eq_(ds.repo.get_hexsha('incoming-native'), native)
+    assert_in('ses-2/func/sub-12345_ses-2_task-rest_bold.nii.gz',
+              ds.repo.get_files('incoming-bids'))
+    assert_status('ok', ds.status(**ckwa))
@@ -0,0 +1,90 @@
+from datalad.tests.utils_pytest import (
+    assert_raises,
+    eq_,
+)
+
+from datalad_ukbiobank.ukb2bids import (
+    _lookup,
+    compile_mapping,
+    compile_rules,
+    get_bids_path,
+    map_ukb2bids,
+)
+
+
+def test_get_bids_path():
+    # full match, with suffixes reappended
+    eq_(get_bids_path('20227_2_0/fMRI/rfMRI.nii.gz', '12345', 'non-bids'),
+        'ses-2/func/sub-12345_ses-2_task-rest_bold.nii.gz')
+    eq_(get_bids_path('25748_3_0.txt', '12345', 'non-bids'),
+        'ses-3/non-bids/fMRI/sub-12345_ses-3_task-hariri_eprime.txt')
+    # directory matches keep the remaining path
+    eq_(get_bids_path('20227_2_0/fMRI/rfMRI.ica/design.fsf', '12345',
+                      'non-bids'),
+        'ses-2/non-bids/fMRI/rfMRI.ica/design.fsf')
+    # a file without suffix is not mistaken for its directory
+    eq_(get_bids_path('20227_2_0/fMRI/README', '12345', 'non-bids'),
+        'ses-2/non-bids/fMRI/README')
+    # no mapping for unrecognized files without a directory for them
+    eq_(get_bids_path('20227_2_0/fMRI/rfMRI.ica/design.fsf', '12345', None),
+        None)
+    eq_(get_bids_path('99999_2_0/some.txt', '12345', 'non-bids'), None)
+    assert_raises(ValueError, get_bids_path, '.gitattributes', '1', None)
+
+
+def test_lookup_precedence():
+    trie = compile_mapping({
+        'a': 'A/',
+        'a/b': 'AB/',
+        'a/b/c': 'ABC',
+        'a/b/c.nii.gz': 'ABCNII',
+    })
+    eq_(_lookup(['a', 'b', 'c.nii.gz'], trie), ('ABCNII', ''))
+    eq_(_lookup(['a', 'b', 'c.json'], trie), ('ABC', '.json'))
+    eq_(_lookup(['a', 'b', 'd', 'e.json'], trie), ('AB/', 'd/e.json'))
+    eq_(_lookup(['a', 'x', 'c'], trie), ('A/', 'x/c'))
+    eq_(_lookup(['z', 'c'], trie), (None, None))
+
+
+def test_rules():
+    rules = compile_rules([
+        (r'a/(?P<x>[0-9]+)_(?P=x)', 'X-{x}'),
+        (r'a/(?P<x>[a-z]+)', 'Y-{x}', {'x': {'foo': 'bar'}}),
+    ])
+    trie = compile_mapping({'a': 'A/', 'a/3_3': 'table'})
+    # table entries take precedence
+    eq_(_lookup(['a', '3_3'], trie, rules), ('table', ''))
+    eq_(_lookup(['a', '4_4.json'], trie, rules), ('X-4', '.json'))
+    eq_(_lookup(['a', '4_5'], trie, rules), ('A/', '4_5'))
+    eq_(_lookup(['a', 'foo'], trie, rules), ('Y-bar', ''))
+    eq_(_lookup(['a', 'baz'], trie, rules), ('Y-baz', ''))
+    # rules also apply outside the table
+    eq_(_lookup(['b', 'a', 'foo'], compile_mapping({}),
+                compile_rules([(r'b/a/(?P<x>.*)', '{x}')])),
+        ('foo', ''))
+    # SWI coils beyond those ever listed in the table
+    eq_(get_bids_path(
+        '20251_2_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL48_ECHO2_20',
+        '12345', 'non-bids'),
+        'ses-2/swi/sub-12345_ses-2_part-phase_coil-48_echo-2_GRE')
+
+
+def test_map_ukb2bids():
+    paths = [
+        '.gitattributes',
+        '20227_2_0/fMRI/rfMRI.nii.gz',
+        '25748_3_0.txt',
+        '99999_2_0/some.txt',
+    ]
+    eq_(map_ukb2bids(iter(paths), '12345'), {
+        '20227_2_0/fMRI/rfMRI.nii.gz':
+            'ses-2/func/sub-12345_ses-2_task-rest_bold.nii.gz',
+        '25748_3_0.txt':
+            'ses-3/non-bids/fMRI/sub-12345_ses-3_task-hariri_eprime.txt',
+        '99999_2_0/some.txt': None,
+    })
+    # session label override
+    eq_(map_ukb2bids(paths[1:2], '12345', session='01'), {
+        '20227_2_0/fMRI/rfMRI.nii.gz':
+            'ses-01/func/sub-12345_ses-01_task-rest_bold.nii.gz',
+    })
@@ -1,5 +1,7 @@
+import logging
 import sys
 import os
+from pathlib import Path
 from unittest.mock import patch
 
 from datalad.api import (
@@ -12,11 +14,20 @@ from datalad.tests.utils_pytest import (
     assert_not_in,
     assert_raises,
     assert_status,
+    assert_true,
     eq_,
     neq_,
     skip_if_on_windows,
     with_tempfile,
 )
+from datalad.utils import swallow_logs
+from datalad_ukbiobank.ingest import (
+    get_manifest_path,
+    ingest_archive,
+    read_manifest,
+)
+from datalad_ukbiobank.ukb2bids import map_ukb2bids
+from datalad_ukbiobank.update import plan_bids_layout
 from datalad_ukbiobank.tests import (
     make_datarecord_zips,
 )
@@ -156,6 +167,14 @@ def test_bids(dspath=None, records=None):
             'ses-3/non-bids/fMRI/sub-12345_ses-3_task-hariri_eprime.txt']:
         assert_in(i, bids_files)
         assert_in(i, master_files)
+    # moved annex links remain valid
+    eq_((ds.pathobj / 'ses-2' / 'func' /
+         'sub-12345_ses-2_task-rest_bold.nii.gz').read_text(),
+        'rfMRI.nii.gz')
+    eq_((ds.pathobj / 'ses-2' / 'non-bids' / 'fMRI' /
+         'sub-12345_ses-2_task-hariri_eprime.txt').read_text(),
+        '25748_2_0.txt')
+    assert_status('ok', ds.status(**ckwa))
 
     # run again, nothing bad happens
     with patch.dict('os.environ', {'PATH': '{}:{}'.format(
@@ -181,6 +200,235 @@ def test_bids(dspath=None, records=None):
         ds.ukb_update(merge=True, force=True, **ckwa)
 
 
+@skip_if_on_windows  # see gh-61
+@with_tempfile
+@with_tempfile(mkdir=True)
+def test_bids_incremental(dspath=None, records=None):
+    make_datarecord_zips('12345', records)
+    ds = create(dspath, **ckwa)
+    ds.ukb_init('12345', ['20227_2_0', '25747_2_0', '25748_2_0'],
+                bids=True, **ckwa)
+    ds.config.add('datalad.ukbiobank.keyfile', 'dummy', scope='local')
+    bin_dir = make_ukbfetch(ds, records)
+
+    def get_bids_tree():
+        return ds.repo.call_git_oneline(
+            ['rev-parse', 'incoming-bids^{tree}'])
+
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}), \
+            patch('datalad_ukbiobank.update.map_ukb2bids',
+                  wraps=map_ukb2bids) as mapper:
+        ds.ukb_update(merge=True, **ckwa)
+        # the first update maps everything
+        assert_in('20227_2_0/fMRI/rfMRI.nii.gz', mapper.call_args[0][0])
+        # add a record, and change another one
+        ds.ukb_init('12345', ['20227_2_0', '25747_2_0', '25748_2_0',
+                              '25748_3_0'],
+                    bids=True, force=True, **ckwa)
+        (Path(records) / '12345_25748_2_0.txt').write_text('changed')
+        ds.ukb_update(merge=True, **ckwa)
+        # only the changes were mapped
+        eq_(sorted(mapper.call_args[0][0]),
+            ['25748_2_0.txt', '25748_3_0.txt'])
+        incremental = get_bids_tree()
+        # remove a record again
+        ds.ukb_init('12345', ['20227_2_0', '25747_2_0', '25748_2_0'],
+                    bids=True, force=True, **ckwa)
+        ds.ukb_update(merge=True, **ckwa)
+        eq_(sorted(mapper.call_args[0][0]), ['25748_3_0.txt'])
+        assert_not_in(
+            'ses-3/non-bids/fMRI/sub-12345_ses-3_task-hariri_eprime.txt',
+            ds.repo.get_files('incoming-bids'))
+        # a full remap yields the same layout
+        removed = get_bids_tree()
+        ds.ukb_update(merge=True, force=True, **ckwa)
+        eq_(get_bids_tree(), removed)
+        ds.ukb_init('12345', ['20227_2_0', '25747_2_0', '25748_2_0',
+                              '25748_3_0'],
+                    bids=True, force=True, **ckwa)
+        ds.ukb_update(merge=True, force=True, **ckwa)
+        eq_(get_bids_tree(), incremental)
+    eq_((ds.pathobj / 'ses-2' / 'non-bids' / 'fMRI' /
+         'sub-12345_ses-2_task-hariri_eprime.txt').read_text(),
+        'changed')
+    assert_status('ok', ds.status(**ckwa))
+
+
+@skip_if_on_windows  # see gh-61
+@with_tempfile
+@with_tempfile(mkdir=True)
+def test_bids_collision(dspath=None, records=None):
+    make_datarecord_zips('12345', records)
+    ds = create(dspath, **ckwa)
+    ds.ukb_init('12345', ['25747_2_0', '25748_2_0', '25748_3_0'],
+                bids=True, **ckwa)
+    ds.config.add('datalad.ukbiobank.keyfile', 'dummy', scope='local')
+    bin_dir = make_ukbfetch(ds, records)
+    target = 'ses-2/non-bids/fMRI/sub-12345_ses-2_task-hariri_eprime.txt'
+
+    def colliding_map(paths, *args, **kwargs):
+        mapped = map_ukb2bids(paths, *args, **kwargs)
+        if '25748_3_0.txt' in mapped:
+            mapped['25748_3_0.txt'] = target
+        return mapped
+
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}), \
+            patch('datalad_ukbiobank.update.map_ukb2bids',
+                  side_effect=colliding_map):
+        res = ds.ukb_update(on_failure='ignore', **ckwa)
+        # both sources are reported, and stay where they are
+        for p in ('25748_2_0.txt', '25748_3_0.txt'):
+            assert_in_results(
+                res, status='error', path=str(ds.pathobj / p),
+                bids_path=str(ds.pathobj / target))
+        bids_files = ds.repo.get_files('incoming-bids')
+        assert_in('25748_2_0.txt', bids_files)
+        assert_in('25748_3_0.txt', bids_files)
+        assert_not_in(target, bids_files)
+        # the plan is available without applying it
+        bids = ds.repo.get_hexsha('incoming-bids')
+        plan = plan_bids_layout(ds, rebuild=True)
+        eq_(plan['collisions'], {target: ['25748_2_0.txt', '25748_3_0.txt']})
+        eq_(plan['moves']['25748_3_0.txt'], '25748_3_0.txt')
+        eq_(ds.repo.get_hexsha('incoming-bids'), bids)
+
+        # once the collision is gone, the remaining file is moved
+        ds.ukb_init('12345', ['25747_2_0', '25748_2_0'],
+                    bids=True, force=True, **ckwa)
+        (Path(records) / '12345_25748_2_0.txt').write_text('changed')
+        assert_status('ok', ds.ukb_update(**ckwa))
+        bids_files = ds.repo.get_files('incoming-bids')
+        assert_in(target, bids_files)
+        assert_not_in('25748_2_0.txt', bids_files)
+        assert_not_in('25748_3_0.txt', bids_files)
+
+        # a new record must not replace an existing BIDS file
+        ds.ukb_init('12345', ['25747_2_0', '25748_2_0', '25748_3_0'],
+                    bids=True, force=True, **ckwa)
+        res = ds.ukb_update(merge=True, on_failure='ignore', **ckwa)
+        assert_in_results(
+            res, status='error', path=str(ds.pathobj / '25748_3_0.txt'),
+            message=('BIDS path %s exists already', target))
+    eq_((ds.pathobj / target).read_text(), 'changed')
+    eq_((ds.pathobj / '25748_3_0.txt').read_text(), '25748_3_0.txt')
+
+
+@skip_if_on_windows  # see gh-61
+@with_tempfile
+@with_tempfile(mkdir=True)
+def test_member_filter(dspath=None, records=None):
+    make_datarecord_zips('12345', records)
+    ds = create(dspath, **ckwa)
+    ds.ukb_init('12345', ['20227_2_0', '25748_2_0'],
+                exclude=['*/rfMRI.ica/*'], **ckwa)
+    eq_(ds.config.get('datalad.ukbiobank.exclude'), '*/rfMRI.ica/*')
+    ds.config.add('datalad.ukbiobank.keyfile', 'dummy', scope='local')
+    bin_dir = make_ukbfetch(ds, records)
+
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}), \
+            patch('datalad_ukbiobank.update.ingest_archive',
+                  wraps=ingest_archive) as ingest, \
+            swallow_logs(new_level=logging.INFO) as cml:
+        ds.ukb_update(merge=True, **ckwa)
+        # no filters were applied before
+        assert_not_in('filters changed', cml.out)
+        native = ds.repo.get_files('incoming-native')
+        assert_in('20227_2_0/fMRI/rfMRI.nii.gz', native)
+        assert_not_in('20227_2_0/fMRI/rfMRI.ica/design.fsf', native)
+        # the archive is kept in full
+        assert_in('12345_20227_2_0.zip', ds.repo.get_files('incoming'))
+        # excluded files are not even decompressed
+        manifest, = get_manifest_path(ds.repo, 'x').parent.glob('*.json')
+        assert_true(all(
+            m['key'] is None
+            for m in read_manifest(ds.repo, manifest.stem)
+            if '/rfMRI.ica/' in m['path']))
+        # changed filters apply to unchanged downloads too
+        assert_status(
+            'ok',
+            ds.ukb_update(merge=True, include=['fMRI/rfMRI.*'], **ckwa))
+        assert_in('filters changed', cml.out)
+        eq_(ds.config.get('datalad.ukbiobank.exclude'), None)
+        native = ds.repo.get_files('incoming-native')
+        assert_in('20227_2_0/fMRI/rfMRI.ica/design.fsf', native)
+        assert_not_in('20227_2_0/fMRI/rfMRI_SBREF.json', native)
+        eq_(ingest.call_count, 2)
+        # narrowing the selection needs no extraction
+        ds.ukb_update(merge=True, include=['fMRI/rfMRI.nii.gz'], **ckwa)
+        eq_(ingest.call_count, 2)
+        assert_not_in('20227_2_0/fMRI/rfMRI.json',
+                      ds.repo.get_files('incoming-native'))
+        # nothing to do with unchanged filters
+        assert_status('notneeded', ds.ukb_update(merge=True, **ckwa))
+    eq_((ds.pathobj / '20227_2_0' / 'fMRI' / 'rfMRI.nii.gz').read_text(),
+        'rfMRI.nii.gz')
+    assert_status('ok', ds.status(**ckwa))
+
+
+@skip_if_on_windows  # see gh-61
+@with_tempfile
+@with_tempfile(mkdir=True)
+def test_bids_only(dspath=None, records=None):
+    make_datarecord_zips('12345', records)
+    ds = create(dspath, **ckwa)
+    ds.ukb_init('12345', ['20227_2_0', '25748_2_0'], bids_only=True, **ckwa)
+    ds.config.add('datalad.ukbiobank.keyfile', 'dummy', scope='local')
+    bin_dir = make_ukbfetch(ds, records)
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}):
+        ds.ukb_update(merge=True, **ckwa)
+    bids_files = ds.repo.get_files('incoming-bids')
+    for i in [
+            'ses-2/func/sub-12345_ses-2_task-rest_bold.nii.gz',
+            'ses-2/func/sub-12345_ses-2_task-rest_bold.json',
+            # records other than archives are not affected
+            'ses-2/non-bids/fMRI/sub-12345_ses-2_task-hariri_eprime.txt']:
+        assert_in(i, bids_files)
+    # nothing extracted that would end up in non-bids/
+    assert_not_in('ses-2/non-bids/fMRI/rfMRI.ica/design.fsf', bids_files)
+    assert_not_in('20227_2_0/fMRI/rfMRI.ica/design.fsf',
+                  ds.repo.get_files('incoming-native'))
+    assert_status('ok', ds.status(**ckwa))
+
+
+@skip_if_on_windows  # see gh-61
+@with_tempfile
+@with_tempfile
+@with_tempfile(mkdir=True)
+@with_tempfile(mkdir=True)
+def test_cache(dspath=None, dspath2=None, records=None, cachedir=None):
+    make_datarecord_zips('12345', records)
+    datasets = []
+    for path in (dspath, dspath2):
+        ds = create(path, **ckwa)
+        ds.ukb_init('12345', ['20227_2_0', '25748_2_0'], **ckwa)
+        ds.config.add('datalad.ukbiobank.keyfile', 'dummy', scope='local')
+        ds.config.add('datalad.ukbiobank.cache', cachedir, scope='local')
+        datasets.append(ds)
+    bin_dir = make_ukbfetch(datasets[0], records)
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}):
+        datasets[0].ukb_update(merge=True, **ckwa)
+        # downloads are no longer available, but cached
+        for fp in Path(records).iterdir():
+            fp.unlink()
+        datasets[1].ukb_update(merge=True, **ckwa)
+    eq_(*[ds.repo.call_git_oneline(['rev-parse', 'incoming^{tree}'])
+          for ds in datasets])
+    eq_((datasets[1].pathobj / '20227_2_0' / 'fMRI' /
+         'rfMRI.nii.gz').read_text(),
+        'rfMRI.nii.gz')
+    assert_status('ok', datasets[1].status(**ckwa))
+
+
 @skip_if_on_windows  # see gh-61
 @with_tempfile
 @with_tempfile(mkdir=True)
@@ -223,3 +471,195 @@ def test_drop(dspath=None, records=None):
     eq_(test_extractfile.read_text(), 'rfMRI.nii.gz')
     # a non-zip content file is still around
     eq_((ds.pathobj / '25747_2_0.adv').read_text(), '25747_2_0.adv')
+
+
+@skip_if_on_windows  # see gh-61
+@with_tempfile
+@with_tempfile(mkdir=True)
+def test_largefiles(dspath=None, records=None):
+    make_datarecord_zips('12345', records)
+    ds = create(dspath, **ckwa)
+    with (ds.pathobj / '.gitattributes').open('a') as f:
+        f.write(
+            '*.txt annex.largefiles=nothing\n'
+            '*.adv annex.largefiles=(largerthan=1kb)\n')
+    ds.save(**ckwa)
+    ds.ukb_init(
+        '12345',
+        ['20227_2_0', '25747_2_0', '25748_2_0', '25748_3_0'], **ckwa)
+    ds.config.add('datalad.ukbiobank.keyfile', 'dummy', scope='local')
+    bin_dir = make_ukbfetch(ds, records)
+
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}):
+        ds.ukb_update(merge=True, **ckwa)
+
+    def get_modes(ref):
+        return dict(
+            (line.split('\t')[1], line.split()[0])
+            for line in ds.repo.call_git_items_(['ls-tree', '-r', ref]))
+
+    incoming = get_modes('incoming')
+    # small files go into git, archives are always annexed
+    eq_(incoming['12345_25748_2_0.txt'], '100644')
+    eq_(incoming['12345_25747_2_0.adv'], '100644')
+    eq_(incoming['12345_20227_2_0.zip'], '120000')
+    native = get_modes('incoming-native')
+    eq_(native['25748_3_0.txt'], '100644')
+    eq_(native['25747_2_0.adv'], '100644')
+    eq_(native['20227_2_0/fMRI/rfMRI.nii.gz'], '120000')
+    assert_true(not (ds.pathobj / '25748_2_0.txt').is_symlink())
+    eq_((ds.pathobj / '25748_2_0.txt').read_text(), '25748_2_0.txt')
+    assert_true(not ds.repo.dirty)
+
+    # rerun has nothing to do
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}):
+        assert_status('notneeded', ds.ukb_update(merge=True, **ckwa))
+
+
+@skip_if_on_windows  # see gh-61
+@with_tempfile
+@with_tempfile(mkdir=True)
+def test_jobs(dspath=None, records=None):
+    make_datarecord_zips('12345', records)
+    ds = create(dspath, **ckwa)
+    ds.ukb_init(
+        '12345',
+        ['20227_2_0', '25747_2_0', '25748_2_0', '25748_3_0'], **ckwa)
+    ds.config.add('datalad.ukbiobank.keyfile', 'dummy', scope='local')
+    bin_dir = make_ukbfetch(ds, records)
+
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}), \
+            patch('datalad_ukbiobank.update.ingest_archive',
+                  wraps=ingest_archive) as ingest:
+        ds.ukb_update(merge=True, jobs=3, **ckwa)
+    # the archive was extracted once, from the download directory while
+    # the download was still running, and that extraction was adopted for
+    # the native layout, instead of extracting the annexed archive again
+    eq_(ingest.call_count, 1)
+    eq_(Path(ingest.call_args[0][0]).parent,
+        ds.pathobj / '.git' / 'tmp' / 'ukb' / 'download')
+    eq_((ds.pathobj / '20227_2_0' / 'fMRI' / 'rfMRI.nii.gz').read_text(),
+        'rfMRI.nii.gz')
+
+    # all shards end up in a single download commit
+    eq_(sorted(f for f in ds.repo.get_files('incoming')
+               if not f.startswith('.')),
+        ['12345_20227_2_0.zip', '12345_25747_2_0.adv',
+         '12345_25748_2_0.txt', '12345_25748_3_0.txt'])
+    # the run record holds the command that was actually run
+    assert_in('ukbfetch-sharded -J3',
+              ds.repo.format_commit('%B', 'incoming'))
+    # with no system-specific information
+    assert_not_in(sys.executable, ds.repo.format_commit('%B', 'incoming'))
+    incoming_p = ds.repo.get_files('incoming-native')
+    for i in ['25748_2_0.txt', '25748_3_0.txt', '20227_2_0/fMRI/rfMRI.nii.gz']:
+        assert_in(i, incoming_p)
+    # no shard leftovers
+    eq_([p.name for p in (ds.pathobj / '.git' / 'tmp' / 'ukb').iterdir()
+         if p.is_dir()],
+        [])
+
+
+@skip_if_on_windows  # see gh-61
+@with_tempfile
+@with_tempfile(mkdir=True)
+def test_incremental(dspath=None, records=None):
+    make_datarecord_zips('12345', records)
+    ds = create(dspath, **ckwa)
+    ds.ukb_init(
+        '12345',
+        ['20227_2_0', '25747_2_0', '25748_2_0', '25748_3_0'], **ckwa)
+    ds.config.add('datalad.ukbiobank.keyfile', 'dummy', scope='local')
+    bin_dir = make_ukbfetch(ds, records)
+
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}):
+        ds.ukb_update(merge=True, incremental=True, **ckwa)
+        eq_((ds.pathobj / '25748_2_0.txt').read_text(), '25748_2_0.txt')
+        # upstream change is not picked up, present records are not
+        # downloaded again
+        (Path(records) / '12345_25748_2_0.txt').write_text('changed')
+        assert_status(
+            'notneeded',
+            ds.ukb_update(merge=True, incremental=True, **ckwa))
+        # unless declared stale
+        assert_status(
+            'impossible',
+            ds.ukb_update(merge=True, stale=['25748_2_0'],
+                          on_failure='ignore', **ckwa))
+        ds.ukb_update(merge=True, incremental=True, stale=['25748_2_0'],
+                      **ckwa)
+        eq_((ds.pathobj / '25748_2_0.txt').read_text(), 'changed')
+        # the run record references the committed, reduced batch
+        eq_(ds.repo.call_git(
+            ['cat-file', '-p', 'incoming:.ukbbatch-incremental']),
+            '12345 25748_2_0\n')
+        assert_in('-b.ukbbatch-incremental',
+                  ds.repo.format_commit('%B', 'incoming'))
+        # records no longer requested are removed
+        ds.ukb_init('12345', ['20227_2_0', '25747_2_0', '25748_2_0'],
+                    force=True, **ckwa)
+        ds.ukb_update(merge=True, incremental=True, **ckwa)
+    assert_not_in('12345_25748_3_0.txt', ds.repo.get_files('incoming'))
+    assert_in('12345_25748_2_0.txt', ds.repo.get_files('incoming'))
+    assert_not_in('25748_3_0.txt', ds.repo.get_files('incoming-native'))
+    assert_status('ok', ds.status(**ckwa))
+
+
+@skip_if_on_windows  # see gh-61
+@with_tempfile
+@with_tempfile(mkdir=True)
+def test_native_rebuild(dspath=None, records=None):
+    make_datarecord_zips('12345', records)
+    ds = create(dspath, **ckwa)
+    ds.ukb_init(
+        '12345',
+        ['20227_2_0', '25747_2_0', '25748_2_0', '25748_3_0'], **ckwa)
+    ds.config.add('datalad.ukbiobank.keyfile', 'dummy', scope='local')
+    bin_dir = make_ukbfetch(ds, records)
+
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}), \
+            patch('datalad_ukbiobank.update.ingest_archive',
+                  wraps=ingest_archive) as ingest:
+        ds.ukb_update(merge=True, **ckwa)
+        eq_(ingest.call_count, 1)
+        native = ds.repo.call_git_oneline(
+            ['rev-parse', 'incoming-native^{tree}'])
+        # a forced rerun on unchanged downloads does not touch the
+        # native layout, nor the worktree
+        inode = os.lstat(str(ds.pathobj / '25748_2_0.txt')).st_ino
+        ds.ukb_update(merge=True, force=True, **ckwa)
+        eq_(ingest.call_count, 1)
+        eq_(ds.repo.call_git_oneline(
+            ['rev-parse', 'incoming-native^{tree}']), native)
+        eq_(os.lstat(str(ds.pathobj / '25748_2_0.txt')).st_ino, inode)
+        # a changed record is updated, without extracting unchanged archives
+        (Path(records) / '12345_25748_2_0.txt').write_text('changed')
+        ds.ukb_update(merge=True, **ckwa)
+        eq_(ingest.call_count, 1)
+        # an archive that reappears is registered from its manifest
+        ds.ukb_init('12345', ['25747_2_0', '25748_2_0', '25748_3_0'],
+                    force=True, **ckwa)
+        ds.ukb_update(merge=True, **ckwa)
+        assert_not_in('20227_2_0/fMRI/rfMRI.nii.gz',
+                      ds.repo.get_files('incoming-native'))
+        ds.ukb_init(
+            '12345',
+            ['20227_2_0', '25747_2_0', '25748_2_0', '25748_3_0'],
+            force=True, **ckwa)
+        ds.ukb_update(merge=True, **ckwa)
+        eq_(ingest.call_count, 1)
+    eq_((ds.pathobj / '25748_2_0.txt').read_text(), 'changed')
+    assert_in('20227_2_0/fMRI/rfMRI.nii.gz',
+              ds.repo.get_files('incoming-native'))
+    assert_true(ds.repo.file_has_content('20227_2_0/fMRI/rfMRI.json'))
+    assert_status('ok', ds.status(**ckwa))
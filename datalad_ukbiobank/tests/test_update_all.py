@@ -0,0 +1,167 @@
+import json
+import os
+from pathlib import Path
+from unittest.mock import patch
+
+from datalad.api import (
+    clone,
+    create,
+)
+from datalad.tests.utils_pytest import (
+    assert_in,
+    assert_in_results,
+    assert_result_count,
+    eq_,
+    skip_if_on_windows,
+    with_tempfile,
+)
+from datalad_ukbiobank.tests import (
+    make_datarecord_zips,
+)
+from datalad_ukbiobank.tests.test_update import (
+    ckwa,
+    make_ukbfetch,
+)
+
+
+def log_ukbfetch_calls(ds, bin_dir):
+    # record the batch of each download, availability checks aside
+    calls = ds.pathobj / '.git' / 'ukbfetch.calls'
+    fake = bin_dir / 'ukbfetch'
+    fake.rename(bin_dir / 'ukbfetch-fake')
+    fake.write_text(
+        '#!/bin/sh\n'
+        'case "$*" in *-b*) cat .ukbbatch >> {0}; echo >> {0};; esac\n'
+        'exec {1} "$@"\n'.format(calls, bin_dir / 'ukbfetch-fake'))
+    fake.chmod(0o744)
+    return calls
+
+
+@skip_if_on_windows  # see gh-61
+@with_tempfile
+@with_tempfile(mkdir=True)
+@with_tempfile
+def test_update_all(dspath=None, records=None, clonedir=None):
+    for p in ('1001', '1002'):
+        make_datarecord_zips(p, records)
+    ds = create(dspath, **ckwa)
+    bulkfile = ds.pathobj / '.git' / 'ukb.bulk'
+    bulkfile.write_text('1001 25748_2_0\n1002 25748_2_0\n')
+    ds.ukb_init_bulk(str(bulkfile), **ckwa)
+    # not a participant dataset
+    create(ds.pathobj / 'other', **ckwa)
+    ds.save(**ckwa)
+    bin_dir = make_ukbfetch(ds, records)
+    journal = ds.pathobj / '.git' / 'datalad' / 'ukb' / 'update-all.journal'
+
+    # a failing participant is recorded in the journal
+    (ds.pathobj / '1002' / 'dirt').write_text('dust')
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}):
+        res = ds.ukb_update_all(keyfile='dummy', merge=True, jobs=2,
+                                on_failure='ignore', **ckwa)
+    assert_in_results(res, action='ukb_update_all', status='error',
+                      counts=dict(ok=1, notneeded=0, error=1, skipped=0, ignored=1))
+    eq_([json.loads(l) for l in journal.read_text().splitlines()
+         if '1002' not in l],
+        [dict(path=str(ds.pathobj / '1001'), status='ok')])
+
+    # a repeated run resumes with outstanding participants only
+    (ds.pathobj / '1002' / 'dirt').unlink()
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}):
+        res = ds.ukb_update_all(keyfile='dummy', merge=True, **ckwa)
+    assert_result_count(res, 1, action='ukb_update', status='ok')
+    assert_in_results(res, action='ukb_update', status='ok',
+                      path=str(ds.pathobj / '1002'))
+    assert_in_results(res, action='ukb_update_all', status='ok',
+                      counts=dict(ok=1, notneeded=0, error=0, skipped=1,
+                                  ignored=1))
+    assert not journal.exists()
+    for p in ('1001', '1002'):
+        assert_in('25748_2_0.txt',
+                  os.listdir(str(ds.pathobj / p)))
+    assert_in_results(res, status='notneeded',
+                      path=str(ds.pathobj / 'other'),
+                      message='Not a UKB participant dataset')
+
+    # participant datasets of a clone only have a remote incoming branch
+    cloned = clone(source=ds.path, path=clonedir, **ckwa)
+    cloned.get('.', get_data=False, recursive=True, **ckwa)
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}):
+        res = cloned.ukb_update_all(keyfile='dummy', force=True, **ckwa)
+    assert_in_results(res, action='ukb_update_all', status='ok',
+                      counts=dict(ok=2, notneeded=0, error=0, skipped=0,
+                                  ignored=1))
+
+
+@skip_if_on_windows  # see gh-61
+@with_tempfile
+@with_tempfile(mkdir=True)
+def test_update_all_cohort_fetch(dspath=None, records=None):
+    for p in ('1001', '1002'):
+        make_datarecord_zips(p, records)
+    ds = create(dspath, **ckwa)
+    bulkfile = ds.pathobj / '.git' / 'ukb.bulk'
+    bulkfile.write_text('1001 25748_2_0\n1002 25748_2_0\n')
+    ds.ukb_init_bulk(str(bulkfile), **ckwa)
+    bin_dir = make_ukbfetch(ds, records)
+    calls = log_ukbfetch_calls(ds, bin_dir)
+
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}):
+        res = ds.ukb_update_all(keyfile='dummy', merge=True,
+                                cohort_fetch=True, jobs=2, **ckwa)
+    assert_in_results(res, action='ukb_cohort_fetch', status='ok')
+    assert_in_results(res, action='ukb_update_all', status='ok',
+                      counts=dict(ok=2, notneeded=0, error=0, skipped=0,
+                                  ignored=0))
+    # a single ukbfetch process downloaded the records of both participants
+    eq_(calls.read_text(), '1001 25748_2_0\n1002 25748_2_0\n\n')
+    for p in ('1001', '1002'):
+        assert_in('25748_2_0.txt',
+                  os.listdir(str(ds.pathobj / p)))
+    # the staged downloads are gone
+    assert not (ds.pathobj / '.git' / 'tmp' / 'ukb' / 'cohort').exists()
+
+
+@skip_if_on_windows  # see gh-61
+@with_tempfile
+@with_tempfile(mkdir=True)
+@with_tempfile(mkdir=True)
+def test_update_all_cohort_fetch_cache(dspath=None, records=None,
+                                       cachedir=None):
+    for p in ('1001', '1002'):
+        make_datarecord_zips(p, records)
+    ds = create(dspath, **ckwa)
+    bulkfile = ds.pathobj / '.git' / 'ukb.bulk'
+    bulkfile.write_text('1001 25748_2_0\n1002 25748_2_0\n')
+    ds.ukb_init_bulk(str(bulkfile), **ckwa)
+    ds.config.add('datalad.ukbiobank.cache', cachedir, scope='local')
+    bin_dir = make_ukbfetch(ds, records)
+    calls = log_ukbfetch_calls(ds, bin_dir)
+
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}):
+        res = ds.ukb_update_all(keyfile='dummy', cohort_fetch=True, **ckwa)
+    assert_in_results(res, action='ukb_update_all', status='ok')
+    # the configured cache was populated, and is kept
+    eq_(sorted(p.name for p in (Path(cachedir) / 'records').iterdir()),
+        ['1001_25748_2_0.json', '1002_25748_2_0.json'])
+    eq_(calls.read_text(), '1001 25748_2_0\n1002 25748_2_0\n\n')
+
+    # cached records are not downloaded again
+    with patch.dict('os.environ', {'PATH': '{}:{}'.format(
+            str(bin_dir),
+            os.environ['PATH'])}):
+        res = ds.ukb_update_all(keyfile='dummy', cohort_fetch=True,
+                                force=True, **ckwa)
+    assert_in_results(res, action='ukb_cohort_fetch', status='ok')
+    assert_in_results(res, action='ukb_update_all', status='ok')
+    eq_(calls.read_text(), '1001 25748_2_0\n1002 25748_2_0\n\n')
@@ -1,127 +1,204 @@
-from os.path import join as opj
-from datalad.utils import Path
-from datalad_ukbiobank.ukb2bids_map import ukb2bids
+import re
+from pathlib import PurePosixPath
+from datalad_ukbiobank.ukb2bids_map import (
+    ukb2bids,
+    ukb2bids_rules,
+)
 
 import logging
 lgr = logging.getLogger('datalad.ukbiobank.ukb2bids')
 
 
-def restructure_ukb2bids(ds, subid, unrecognized_dir, base_path=None):
-    """Perform the necessary renames to restructure to BIDS
+def compile_mapping(mapping):
+    """Compile a path mapping into a trie of path components
+
+    Each node is a dict of child nodes, with the path components as keys.
+    The mapping target of a node's path is stored under the key None.
+    """
+    trie = {}
+    for pattern, target in mapping.items():
+        node = trie
+        for part in pattern.split('/'):
+            node = node.setdefault(part, {})
+        node[None] = target
+    return trie
+
+
+def compile_rules(rules):
+    """Compile pattern rules into a single combined regular expression
+
+    Each rule is wrapped into a named group, and its own named groups are
+    prefixed with the rule's name to keep them apart.
+
+    Returns
+    -------
+    (Pattern, dict)
+      The combined expression, and the (target, value translations) of each
+      rule, with the name of the rule's group as key.
+    """
+    alternatives = []
+    targets = {}
+    for i, rule in enumerate(rules):
+        pattern, target = rule[:2]
+        name = '_r{}'.format(i)
+        pattern = re.sub(
+            r'\(\?P([<=])(\w+)',
+            r'(?P\1{}_\2'.format(name),
+            pattern)
+        alternatives.append('(?P<{}>{})'.format(name, pattern))
+        targets[name] = (target, rule[2] if len(rule) > 2 else {})
+    return re.compile('|'.join(alternatives)), targets
+
+
+def _match_rules(path, rules):
+    """Return the target of the pattern rule matching a path, or None"""
+    regex, targets = rules
+    match = regex.fullmatch(path)
+    if match is None:
+        return None
+    name = match.lastgroup
+    target, translations = targets[name]
+    prefix = '{}_'.format(name)
+    for field, value in match.groupdict().items():
+        if value is None or not field.startswith(prefix):
+            continue
+        field = field[len(prefix):]
+        target = target.replace(
+            '{{{}}}'.format(field),
+            translations.get(field, {}).get(value, value))
+    return target
+
+
+_ukb2bids_trie = compile_mapping(ukb2bids)
+_ukb2bids_rules = compile_rules(ukb2bids_rules)
+
+
+def _lookup(parts, trie=_ukb2bids_trie, rules=_ukb2bids_rules):
+    """Find the best mapping for a path in a single walk down the trie
+
+    Matches are tried in order: the full path, the path with the file name
+    suffix(es) stripped, and the longest leading directory. For the first
+    two, a mapping table entry takes precedence over a pattern rule.
+
+    Returns
+    -------
+    (str, str) or (None, None)
+      The mapping target and the remainder of the path to append to it.
+    """
+    # longest matching leading directory
+    best = (None, None)
+    node = trie
+    for i, part in enumerate(parts[:-1]):
+        node = node.get(part)
+        if node is None:
+            # no table entry below this point, only rules can match
+            node = {}
+            break
+        if None in node:
+            best = (node[None], '/'.join(parts[i + 1:]))
+    fname = PurePosixPath(parts[-1])
+    candidates = [(fname.name, '')]
+    if fname.suffixes:
+        suffix = ''.join(fname.suffixes)
+        candidates.append((fname.name[:-len(suffix)], suffix))
+    for name, suffix in candidates:
+        target = node.get(name, {}).get(None)
+        if target is None:
+            target = _match_rules('/'.join(parts[:-1] + [name]), rules)
+        if target is not None:
+            return target, suffix
+    return best
+
+
+def get_bids_path(path, subid, unrecognized_dir, session=None):
+    """Map a path in the native layout to its BIDS counterpart
+
+    This is a pure function of the path, no file system access is needed.
 
     Parameters
     ----------
-    ds : Dataset
-      DataLad dataset instance to restructure. The checked-out branch
-      is taken as the subject of restructuring.
+    path : str
+      POSIX path relative to the root of the native layout.
     subid : str
       Participant ID
     unrecognized_dir : str or None
       Name of a directory to put all unrecognized files into. The given
       value is used to populate the 'unrecogdir' substitution label
-      in `ukb2bids_map`. If None, unrecognized files will not be moved.
+      in `ukb2bids_map`. If None, unrecognized files have no mapping.
       The directory will be placed inside the respective session directory.
-    base_path : Path-like
-      Base path to determine relative path names of any file for BIDS
-      mapping
+    session : str, optional
+      Session label to use instead of the instance number of the data
+      record.
+
+    Returns
+    -------
+    str or None
+      POSIX path relative to the root of the BIDS layout, or None if no
+      mapping is available.
+
+    Raises
+    ------
+    ValueError
+      If the path does not look like part of a UKB data record.
     """
-    # shortcut
-    repo = ds.repo
-
-    # prep for yield
-    res = dict(
-        action='ukb_bidsify',
-        type='file',
-        logger=lgr,
-        refds=ds.path,
-    )
-
-    # loop over all known files
-    for fp in ds.status(
-            path=base_path,
-            annex=None,
-            untracked='all',
-            eval_subdataset_state='no',
-            return_type='generator',
-            result_renderer=None):
-        path = Path(fp['path'])
-        if not path.exists():
-            lgr.debug('Skip mapping %s, no longer exists (likely moved before)', path)
-            continue
-        rp_parts = list(Path(fp['path']).relative_to(base_path or ds.pathobj).parts)
-        # instance number will serve as BIDS session
+    rp_parts = list(PurePosixPath(path).parts)
+    # instance number will serve as BIDS session
+    try:
+        instance = rp_parts[0].split('_')[1]
+    except IndexError:
+        raise ValueError('Not a UKB data record path: {}'.format(path))
+    if session is None:
+        session = instance
+    # pull out instance number from the top-level component, because the matching
+    # is uniform and agnostic of instances
+    rp_parts[0] = '_'.join(rp_parts[0].split('_')[::2])
+    target_path, suffix = _lookup(rp_parts)
+    if target_path is not None:
+        # append suffix, and apply substitutions
+        target_path = (target_path + suffix).format(
+            subj=subid,
+            session='ses-{}'.format(session),
+            unrecogdir='@@UNRECOG@@'
+            if unrecognized_dir is None
+            else 'ses-{}/{}'.format(session, unrecognized_dir),
+        )
+    if target_path is None or '@@UNRECOG@@' in target_path:
+        return None
+    return target_path
+
+
+def map_ukb2bids(paths, subid, unrecognized_dir='non-bids', session=None):
+    """Map native-layout paths to their BIDS counterparts in bulk
+
+    No dataset or file system access is needed, hence layouts can be
+    planned before any data is available.
+
+    Parameters
+    ----------
+    paths : iterable
+      POSIX paths relative to the root of the native layout.
+    subid : str
+      Participant ID
+    unrecognized_dir : str or None
+      Name of a directory to put all unrecognized files into, see
+      `get_bids_path()`.
+    session : str, optional
+      Session label to use for all paths, instead of the instance number
+      of the respective data record.
+
+    Returns
+    -------
+    dict
+      BIDS path (relative to the root of the BIDS layout) of each data
+      record path, or None if no mapping is available. Paths that do not
+      look like part of a UKB data record are not included.
+    """
+    mapped = {}
+    for path in paths:
         try:
-            session = rp_parts[0].split('_')[1]
-        except IndexError:
-            # ignore anything that doesn't look like a UKB data record
-            continue
-        # pull out instance number from the top-level component, because the matching
-        # is uniform and agnostic of instances
-        rp_parts[0] = '_'.join(rp_parts[0].split('_')[::2])
-        fname = Path(rp_parts[-1])
-        # build a list of candidate mapping to try, and suffixes to reappend
-        # upon a successful match
-        cands = [
-            # full thing
-            (str(Path(*rp_parts)), ''),
-            # without suffix(es)
-            (str(Path(
-                *rp_parts[:-1],
-                fname.name[:-sum(len(s) for s in fname.suffixes)])),
-             ''.join(fname.suffixes)),
-        ]
-        # all intermediate path components
-        cands += reversed([
-            (str(Path(*rp_parts[:i + 1])),
-             str(Path(*rp_parts[i + 1:])))
-            for i in range(len(rp_parts) - 1)
-        ])
-        for pattern, suffix in cands:
-            target_path = ukb2bids.get(pattern, None)
-            if target_path is not None:
-                # append suffix
-                if isinstance(suffix, Path):
-                    target_path = opj(str(target_path), suffix)
-                else:
-                    target_path = target_path + suffix
-                # apply substitutions
-                target_path = target_path.format(
-                    subj=subid,
-                    session='ses-{}'.format(session),
-                    unrecogdir='@@UNRECOG@@'
-                    if unrecognized_dir is None
-                    else Path('ses-{}'.format(session)) / unrecognized_dir,
-                )
-                break
-        if target_path is None or '@@UNRECOG@@' in target_path:
-            yield dict(
-                res,
-                path=fp['path'],
-                status='impossible',
-                message='No BIDS file name mapping available',
-            )
+            mapped[path] = get_bids_path(
+                path, subid, unrecognized_dir, session=session)
+        except ValueError:
             continue
-        full_sourcepath = Path(fp['path'])
-        full_targetpath = ds.pathobj / target_path
-        if full_targetpath.exists():
-            lgr.info('Overwriting %s', str(target_path))
-            target_path.unlink()
-        else:
-            # ensure target directory
-            full_targetpath.parent.mkdir(parents=True, exist_ok=True)
-        full_sourcepath.rename(full_targetpath)
-        # delete empty source directories
-        for p in full_sourcepath.parents:
-            try:
-                p.rmdir()
-            except OSError:
-                lgr.debug(
-                    "Not removing non-empty parent directory of %s",
-                    fp['path'])
-                break
-        yield dict(
-            res,
-            path=fp['path'],
-            bids_path=str(full_targetpath),
-            status='ok',
-        )
+    return mapped
+
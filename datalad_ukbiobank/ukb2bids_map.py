@@ -49,132 +49,19 @@ ukb2bids = {
 '20251_0/SWI/SWI_TOTAL_PHA': '{session}/swi/sub-{subj}_{session}_part-phase_echo-1_GRE',
 '20251_0/SWI/SWI_TOTAL_MAG_TE2': '{session}/swi/sub-{subj}_{session}_part-mag_echo-2_rec-norm_GRE',
 '20251_0/SWI/SWI_TOTAL_PHA_TE2': '{session}/swi/sub-{subj}_{session}_part-phase_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL26_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-26_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL21_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-21_echo-2_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL15_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-15_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL09_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-09_echo-1_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL08_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-08_echo-2_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL22_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-22_echo-2_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL28_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-28_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL29_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-29_echo-1_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL08_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-08_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL05_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-05_echo-1_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL12_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-12_echo-1_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL12_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-12_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL30_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-30_echo-1_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL05_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-05_echo-1_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL09_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-09_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL01_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-01_echo-2_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL13_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-13_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL13_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-13_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL21_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-21_echo-1_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL22_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-22_echo-1_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL10_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-10_echo-2_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL12_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-12_echo-2_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL15_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-15_echo-2_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL09_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-09_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL16_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-16_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL18_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-18_echo-1_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL23_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-23_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL30_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-30_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL31_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-31_echo-1_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL02_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-02_echo-2_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL07_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-07_echo-1_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL31_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-31_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL29_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-29_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL13_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-13_echo-1_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL24_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-24_echo-1_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL19_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-19_echo-2_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL25_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-25_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL25_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-25_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL24_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-24_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL22_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-22_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL01_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-01_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL04_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-04_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL27_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-27_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL27_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-27_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL14_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-14_echo-1_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL01_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-01_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL28_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-28_echo-1_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL03_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-03_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL30_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-30_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL15_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-15_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL23_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-23_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL28_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-28_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL27_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-27_echo-1_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL19_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-19_echo-1_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL16_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-16_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL05_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-05_echo-2_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL32_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-32_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL07_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-07_echo-1_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL02_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-02_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL01_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-01_echo-1_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL30_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-30_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL23_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-23_echo-2_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL26_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-26_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL09_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-09_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL03_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-03_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL17_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-17_echo-2_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL12_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-12_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL06_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-06_echo-2_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL11_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-11_echo-1_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL31_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-31_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL11_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-11_echo-2_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL21_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-21_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL22_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-22_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL06_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-06_echo-1_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL11_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-11_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL25_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-25_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL16_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-16_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL31_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-31_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL07_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-07_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL04_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-04_echo-1_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL27_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-27_echo-2_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL24_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-24_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL17_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-17_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL19_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-19_echo-1_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL20_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-20_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL18_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-18_echo-2_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL24_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-24_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL19_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-19_echo-2_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL20_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-20_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL29_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-29_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL32_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-32_echo-2_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL29_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-29_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL02_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-02_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL20_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-20_echo-2_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL28_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-28_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL26_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-26_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL07_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-07_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL04_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-04_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL25_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-25_echo-1_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL18_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-18_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL18_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-18_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL21_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-21_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL32_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-32_echo-1_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL13_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-13_echo-2_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL08_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-08_echo-1_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL20_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-20_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL14_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-14_echo-2_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL23_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-23_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL17_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-17_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL15_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-15_echo-2_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL08_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-08_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL06_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-06_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL03_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-03_echo-2_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL17_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-17_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL02_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-02_echo-2_GRE',
-'20251_0/SWI/MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL10_ECHO1_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-10_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL03_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-03_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL16_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-16_echo-2_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL04_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-04_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL14_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-14_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL26_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-26_echo-2_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL14_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-14_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL10_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-10_echo-2_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL10_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-10_echo-1_GRE',
-'20251_0/SWI/PHA_TE1/SWI_3MM_UPDATED_V1.1_COIL32_ECHO1_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-32_echo-1_GRE',
-'20251_0/SWI/PHA_TE2/SWI_3MM_UPDATED_V1.1_COIL05_ECHO2_20': '{session}/swi/sub-{subj}_{session}_part-phase_coil-05_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL06_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-06_echo-2_GRE',
-'20251_0/SWI/MAG_TE2/SWI_3MM_UPDATED_V1.1_COIL11_ECHO2_17': '{session}/swi/sub-{subj}_{session}_part-mag_coil-11_echo-2_GRE',
 }
+
+# pattern rules for families of files that only differ in some fields.
+# like the keys of `ukb2bids`, patterns are matched against a path with
+# the instance number removed from the data record, with or without the
+# file name suffix(es), but only ever name files, not directories.
+# patterns are regular expressions, the values of
+# their named groups are substituted into the target. an optional mapping
+# translates captured values into their BIDS labels
+ukb2bids_rules = [
+# individual SWI coils, e.g. MAG_TE1/SWI_3MM_UPDATED_V1.1_COIL26_ECHO1_17
+(r'20251_0/SWI/(?P<part>MAG|PHA)_TE(?P<echo>[0-9]+)/'
+ r'SWI_3MM_UPDATED_V1\.1_COIL(?P<coil>[0-9]+)_ECHO(?P=echo)_[0-9]+',
+ '{session}/swi/sub-{subj}_{session}_part-{part}_coil-{coil}_echo-{echo}_GRE',
+ {'part': {'MAG': 'mag', 'PHA': 'phase'}}),
+]
@@ -10,23 +10,35 @@
 
 """
 
+import json
 import logging
-import subprocess
+import re
 import shutil
+import subprocess
+import threading
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from fnmatch import fnmatch
+from functools import partial
+from pathlib import PurePosixPath
 
 from datalad.interface.base import Interface
 from datalad.interface.base import eval_results
 from datalad.interface.base import build_doc
-from datalad.local.add_archive_content import AddArchiveContent
 from datalad.support.constraints import (
     EnsureChoice,
+    EnsureInt,
+    EnsureRange,
     EnsureStr,
     EnsureNone,
 )
 from datalad.support.param import Parameter
 from datalad.support.exceptions import CommandError
 from datalad.utils import (
-    chpwd,
+    ensure_list,
     quote_cmdlinearg,
     Path,
 )
@@ -37,11 +49,53 @@ from datalad.distribution.dataset import (
     require_dataset,
 )
 
+from datalad_ukbiobank.cache import (
+    add_cached_record,
+    evict,
+    get_cached_record,
+)
+from datalad_ukbiobank.fetch import read_batchfile
+from datalad_ukbiobank.ingest import (
+    NO_MEMBER_FILTERS,
+    get_annex_backend,
+    get_large_files,
+    get_member_filter,
+    get_member_filters,
+    ingest_archive,
+    ingest_file,
+    read_manifest,
+    register_archive_content,
+    register_present_keys,
+    store_member_filters,
+    write_manifest,
+)
+from datalad_ukbiobank.plumbing import (
+    MODE_FILE,
+    add_annex_links,
+    commit_tree,
+    ensure_local_branch,
+    get_changed_paths,
+    get_tree,
+    get_tree_entries,
+    hash_blobs,
+    hash_files,
+    move_entries,
+    update_branch,
+    write_tree,
+)
+from datalad_ukbiobank.ukb2bids import (
+    get_bids_path,
+    map_ukb2bids,
+)
+
 
 __docformat__ = 'restructuredtext'
 
 lgr = logging.getLogger('datalad.ukbiobank.update')
 
+# batch file of the last incremental download, on the incoming branch
+_incremental_batchfile = '.ukbbatch-incremental'
+
 
 @build_doc
 class Update(Interface):
@@ -52,6 +106,13 @@ class Update(Interface):
 
     Downloads are performed with the `ukbfetch` tool, which is expected to
     be available and executable.
+
+    If a download cache directory is configured (datalad.ukbiobank.cache),
+    data records found there are not downloaded again, once their size and
+    checksum are verified. Fresh downloads are added to the cache. The
+    cache can be shared by any number of datasets. If
+    datalad.ukbiobank.cache-size is set (in bytes), the least recently used
+    records are evicted to keep the cache within this size.
     """
 
     _params_ = dict(
@@ -91,13 +152,63 @@ class Update(Interface):
             By default no content is dropped, duplicating archive content in
             extracted form.""",
             constraints=EnsureChoice(None, 'extracted', 'archives')),
+        jobs=Parameter(
+            args=('-J', '--jobs'),
+            metavar='N',
+            doc="""split the download into one shard per data record, and
+            run up to N 'ukbfetch' processes in parallel, each in a separate
+            temporary directory. Downloaded archives are extracted while
+            other downloads are still in progress. All downloads are still
+            recorded in a single commit on the incoming branch. By default, a
+            single 'ukbfetch' process downloads all records in series.""",
+            constraints=EnsureInt() & EnsureRange(min=1) | EnsureNone()),
+        incremental=Parameter(
+            args=('--incremental',),
+            action='store_true',
+            doc="""only download data records that are not yet present on
+            the incoming branch (or are declared stale). Previously downloaded
+            records are kept as they are, and files of records that are no
+            longer listed in the batch file are removed. The batch of records
+            to download is committed as .ukbbatch-incremental, and referenced
+            by the run record. By default, all records are downloaded again
+            to detect any upstream change."""),
+        stale=Parameter(
+            args=('--stale',),
+            metavar='DATARECORD-ID',
+            action='append',
+            doc="""data record to download again in incremental mode, even
+            if it is already present on the incoming branch. Requires
+            --incremental.
+            [CMD: This option can be given multiple times. CMD]""",
+            constraints=EnsureStr() | EnsureNone()),
+        include=Parameter(
+            args=('--include',),
+            metavar='GLOB',
+            action='append',
+            doc="""only extract archive files whose path (within the archive)
+            matches this pattern into incoming-native. Replaces the filters
+            stored in the dataset configuration (datalad.ukbiobank.include,
+            datalad.ukbiobank.exclude) by ukb-init. Archives are always kept
+            in full on the incoming branch.
+            [CMD: This option can be given multiple times. CMD]""",
+            constraints=EnsureStr() | EnsureNone()),
+        exclude=Parameter(
+            args=('--exclude',),
+            metavar='GLOB',
+            action='append',
+            doc="""do not extract archive files whose path (within the
+            archive) matches this pattern into incoming-native, see
+            --include.
+            [CMD: This option can be given multiple times. CMD]""",
+            constraints=EnsureStr() | EnsureNone()),
 
     )
     @staticmethod
     @datasetmethod(name='ukb_update')
     @eval_results
     def __call__(keyfile=None, merge=False, force=False, drop=None,
-                 dataset=None):
+                 jobs=None, incremental=False, stale=None, include=None,
+                 exclude=None, dataset=None):
         ds = require_dataset(
             dataset, check_installed=True, purpose='update')
 
@@ -124,6 +235,15 @@ class Update(Interface):
             refds=ds.path,
         )
 
+        if stale and not incremental:
+            yield dict(
+                res,
+                status='impossible',
+                message='Stale data records can only be declared in '
+                        'incremental mode',
+            )
+            return
+
         if repo.dirty:
             yield dict(
                 res,
@@ -132,6 +252,10 @@ class Update(Interface):
             )
             return
 
+        if include or exclude:
+            store_member_filters(ds, include=include, exclude=exclude)
+        filters = get_member_filters(ds)
+
         # check if we have 'ukbfetch' before we start fiddling with the dataset
         # and leave it in a mess for no reason
         try:
@@ -149,141 +273,233 @@ class Update(Interface):
         # when we are done
         initial_branch = repo.get_active_branch()
 
-        # make sure we are in incoming, this should create a local branch
-        # tracking the remote
-        repo.call_git(['checkout', 'incoming'])
+        # all incoming branches are updated without checking them out,
+        # but we need local branches to do that, e.g. in a fresh clone
+        for branch in ('incoming', 'incoming-native', 'incoming-bids'):
+            ensure_local_branch(repo, branch)
         initial_incoming = repo.get_hexsha('incoming')
 
-        # first wipe out all prev. downloaded zip files so we can detect
-        # when some files are no longer available
-        for fp in repo.pathobj.glob('[0-9]*_[0-9]*_[0-9]_[0-9].*'):
-            fp.unlink()
-
         # a place to put the download logs
         # better be semi-persistent to ease inspection
         tmpdir = repo.pathobj / repo.get_git_dir(repo) / 'tmp' / 'ukb'
         tmpdir.mkdir(parents=True, exist_ok=True)
+        # downloads land here, before they are annexed
+        downloaddir = tmpdir / 'download'
+        # leftovers of an interrupted run are of no use
+        shutil.rmtree(str(downloaddir), ignore_errors=True)
+        downloaddir.mkdir()
+
+        # ukbfetch runs in the download directory, just like it would at
+        # the root of a checkout of the incoming branch
+        batchpath = downloaddir / '.ukbbatch'
+        batchpath.write_text(repo.call_git(
+            ['cat-file', '-p', 'incoming:.ukbbatch'], read_only=True))
+        batch = read_batchfile(batchpath)
+        # the batch file as referenced in the run record
+        batchfile = '.ukbbatch'
+        incoming_entries = get_tree_entries(repo, 'incoming')
+        outputs = ['.']
+        if incremental:
+            stale = set(ensure_list(stale))
+            wanted = {'{}_{}'.format(p, r): r for p, r in batch}
+            present = set()
+            removed = []
+            for path in sorted(filter(_is_record_file, incoming_entries)):
+                rec = path.split('.', 1)[0]
+                if wanted.get(rec) in stale or rec not in wanted:
+                    # stale, or no longer requested
+                    del incoming_entries[path]
+                    removed.append(path)
+                else:
+                    present.add(rec)
+            batch = [
+                (p, r) for p, r in batch
+                if '{}_{}'.format(p, r) not in present
+            ]
+            if batch:
+                # download only the missing records. the reduced batch is
+                # committed along with the download, such that `datalad
+                # rerun` can repeat it
+                content = ''.join('{} {}\n'.format(p, r) for p, r in batch)
+                batchpath.write_text(content)
+                batchfile = _incremental_batchfile
+                incoming_entries[batchfile] = (
+                    MODE_FILE, hash_blobs(repo, [content])[content])
+            # the run record only covers what could have changed
+            outputs = [
+                '{}_{}.*'.format(p, r) for p, r in batch] + removed
+        else:
+            # first wipe out all prev. downloaded files so we can detect
+            # when some files are no longer available
+            for path in list(filter(_is_record_file, incoming_entries)):
+                del incoming_entries[path]
 
-        # redownload, run with explicit mode, because we just deleted the
-        # ZIP files and that is OK
-        ds.run(
-            cmd='ukbfetch -v -a{} -b.ukbbatch -o{}'.format(
-                quote_cmdlinearg(keyfile),
-                # use relative path to tmpdir to avoid leakage
-                # of system-specific information into the run record
-                quote_cmdlinearg(str(tmpdir.relative_to(repo.pathobj))),
-            ),
-            explicit=True,
-            outputs=['.'],
-            message="Update from UKBiobank",
+        # records that are not in the download cache
+        tofetch = batch
+        cachedir = repo.config.get('datalad.ukbiobank.cache')
+        if cachedir and batch:
+            tofetch = []
+            for p, r in batch:
+                if get_cached_record(
+                        cachedir, '{}_{}'.format(p, r), downloaddir) is None:
+                    tofetch.append((p, r))
+                else:
+                    lgr.info('Using cached download of %s %s', p, r)
+            batchpath.write_text(''.join(
+                '{} {}\n'.format(p, r) for p, r in tofetch))
+
+        # the download command, as run, and as recorded
+        fetcher = ['ukbfetch'] if jobs is None else [
+            'ukbfetch-sharded', '-J{}'.format(jobs)]
+
+        # record archives are decompressed and hashed straight into the
+        # annex by a pool of workers. decompression, hashing, and file IO do
+        # not hold the GIL, hence threads scale fine, and do not need to be
+        # spawned as processes
+        backend = get_annex_backend(repo, '.')
+        objdir = repo.dot_git / 'annex' / 'objects'
+        pool = ThreadPoolExecutor(max_workers=jobs or 1)
+        extract = partial(submit_extraction, pool, objdir, backend)
+        # in sharded mode, downloads only appear in the download directory
+        # once they are complete, and can be extracted while the others are
+        # still running
+        prefetched = {}
+        prefetch_stop = threading.Event()
+        prefetcher = threading.Thread(
+            target=_prefetch_archives,
+            args=(
+                downloaddir,
+                prefetch_stop,
+                lambda fp: extract(fp, select=_get_member_selector(
+                    filters, _get_participant(repo), fp)),
+                prefetched),
+            daemon=True,
         )
+        if tofetch and jobs is not None:
+            prefetcher.start()
+
+        exitcode = 0
+        try:
+            if tofetch:
+                exitcode = subprocess.run(
+                    fetcher + [
+                        '-v',
+                        '-a{}'.format(repo.pathobj / keyfile),
+                        '-b{}'.format(batchpath.name),
+                        '-o{}'.format(tmpdir),
+                    ],
+                    cwd=str(downloaddir),
+                ).returncode
+        finally:
+            prefetch_stop.set()
+            if prefetcher.is_alive():
+                prefetcher.join()
+
+        if exitcode:
+            pool.shutdown()
+            yield dict(
+                res,
+                status='error',
+                message=('Download failed (exit code %i), logs are in %s',
+                         exitcode, tmpdir),
+            )
+            return
+
+        if cachedir and tofetch:
+            # cache fresh downloads, before they are moved into the annex
+            for p, r in tofetch:
+                rec = '{}_{}'.format(p, r)
+                paths = sorted(downloaddir.glob('{}.*'.format(rec)))
+                if paths:
+                    add_cached_record(cachedir, rec, paths)
+            maxsize = repo.config.get('datalad.ukbiobank.cache-size')
+            if maxsize:
+                evict(cachedir, int(maxsize))
+
+        # annex all downloads, once prefetching no longer reads from them
+        wait(list(prefetched.values()))
+        downloads = {}
+        for fp in sorted(downloaddir.iterdir()):
+            if _is_record_file(fp.name):
+                downloads[fp.name] = fp
+            elif fp != batchpath:
+                lgr.warning('Ignoring unexpected download %s', fp.name)
+        # honor annex.largefiles like a `datalad save` would, except for
+        # archives: their content is registered against the archive's key
+        large = get_large_files(repo, {
+            name: fp for name, fp in downloads.items()
+            if not name.endswith('.zip')})
+        fetched = {
+            name: pool.submit(ingest_file, str(fp), objdir, backend)
+            for name, fp in downloads.items()
+            if name.endswith('.zip') or name in large
+        }
+        fetched = {name: f.result() for name, f in fetched.items()}
+        blobs = hash_files(repo, [
+            fp for name, fp in downloads.items() if name not in fetched])
+        incoming_entries.update(
+            (fp.name, (MODE_FILE, blobs[str(fp)]))
+            for name, fp in downloads.items() if name not in fetched)
+        shutil.rmtree(str(downloaddir), ignore_errors=True)
+        for r in register_present_keys(
+                repo, {key: name for name, key in fetched.items()}):
+            yield dict(r, logger=lgr, refds=ds.path)
+        add_annex_links(
+            repo, incoming_entries,
+            [(key, name) for name, key in fetched.items()])
+
+        tree = write_tree(repo, incoming_entries)
+        if tree != get_tree(repo, initial_incoming):
+            if batch:
+                # like `datalad run`, such that `datalad rerun` on a checkout
+                # of the incoming branch repeats the download
+                message = _format_run_message(
+                    ds,
+                    # use relative path to tmpdir to avoid leakage
+                    # of system-specific information into the run record
+                    cmd='{} -v -a{} -b{} -o{}'.format(
+                        ' '.join(quote_cmdlinearg(a) for a in fetcher),
+                        quote_cmdlinearg(keyfile),
+                        quote_cmdlinearg(batchfile),
+                        quote_cmdlinearg(
+                            str(tmpdir.relative_to(repo.pathobj))),
+                    ),
+                    outputs=outputs,
+                    message="Update from UKBiobank",
+                )
+            else:
+                # nothing downloaded, but records removed
+                message = "Remove data records no longer requested"
+            update_branch(
+                repo, 'incoming',
+                commit_tree(repo, tree, [initial_incoming], message),
+                initial_incoming)
 
         # TODO what if something broke before? needs force switch
-        if not force and repo.get_hexsha() == initial_incoming:
+        if not force and repo.get_hexsha('incoming') == initial_incoming \
+                and filters == _get_built_member_filters(repo):
             yield dict(
                 res,
                 status='notneeded',
                 message='No new content available',
             )
-            repo.call_git(['checkout', initial_branch])
+            pool.shutdown()
             # TODO drop?
             return
 
         # onto extraction and transformation of downloaded content
-        repo.call_git(['checkout', 'incoming-native'])
-
-        # mark the incoming change as merged
-        # (but we do not actually want any branch content)
-        repo.call_git(['merge', 'incoming', '--strategy=ours'])
-
-        for fp in repo.get_content_info(
-			ref='incoming-native'):
-            if fp.name.startswith('.git') \
-                    or fp.name.startswith('.datalad') \
-                    or fp.name.startswith('.ukb'):
-                # skip internals
-                continue
-            fp.unlink()
-
-        # discover all files present in the last commit in 'incoming'
-        for fp, props in repo.get_content_annexinfo(
-                ref='incoming', eval_availability=False).items():
-            if fp.name.startswith('.git') \
-                    or fp.name.startswith('.datalad') \
-                    or fp.name.startswith('.ukb'):
-                # skip internals
-                continue
-            # we have to extract into per-instance directories, otherwise files
-            # would conflict
-            ids = fp.stem.split('_')
-            if not len(ids) >= 3:
-                raise RuntimeError('Unrecognized filename structure: {}'.format(fp))
-            # build an ID from the data record and the array index
-            rec_id = '_'.join(ids[1:])
-
-            if fp.suffix == '.zip':
-                extract_dir = repo.pathobj / rec_id
-                extract_dir.mkdir(exist_ok=True)
-                with chpwd(extract_dir):
-                    # extract and add their content
-                    AddArchiveContent.__call__(
-                        props['key'],
-                        key=True,
-                        dataset=ds,
-                        # --use-current-dir due to
-                        # https://github.com/datalad/datalad/issues/3995
-                        use_current_dir=True,
-                        allow_dirty=True,
-                        commit=False,
-                    )
-            else:
-                # move into instance dir, and strip participant ID, and instance ID
-                # but keep array index
-                # e.g. -> 25747_3_0.adv -> instance-3/25747_0
-                repo.call_git([
-                    'annex', 'fromkey', props['key'],
-                    str(repo.pathobj / (rec_id + ''.join(fp.suffixes)))])
-
-        # save whatever the state is now, `save` will discover deletions
-        # automatically and also commit them -- wonderful!
-        ds.save(message="Update native layout")
+        try:
+            yield from update_native_layout(ds, extract, prefetched)
+        finally:
+            pool.shutdown()
         yield dict(
             res,
             status='ok',
         )
 
-        want_bids = 'incoming-bids' in repo.get_branches() \
-            or any(b.endswith('/incoming-bids') for b in repo.get_remote_branches())
+        want_bids = 'incoming-bids' in repo.get_branches()
         if want_bids:
-            repo.call_git(['checkout', 'incoming-bids'])
-            # mark the incoming change as merged
-            # (but we do not actually want any branch content)
-            repo.call_git(['merge', 'incoming', '--strategy=ours'])
-            # prepare the worktree to match the latest state
-            # of incoming-native but keep histories separate
-            # (ie. no merge), because we cannot handle partial
-            # changes
-            repo.call_git(['read-tree', '-u', '--reset', 'incoming-native'])
-            # unstage change to present a later `datalad save` a single
-            # changeset to be saved (otherwise it might try to keep staged
-            # content staged und only save additional modifications)
-            #repo.call_git(['restore', '--staged', '.'])
-            repo.call_git(['reset', 'HEAD', '.'])
-
-            # and now do the BIDSification
-            from datalad_ukbiobank.ukb2bids import restructure_ukb2bids
-            # get participant ID from batch file
-            subid = list(repo.call_git_items_(
-                ["cat-file", "-p", "incoming:.ukbbatch"])
-            )[0].split(maxsplit=1)[0]
-
-            yield from restructure_ukb2bids(
-                ds,
-                subid=subid,
-                unrecognized_dir='non-bids',
-                base_path=repo.pathobj,
-            )
-            ds.save(message="Update BIDS layout")
+            yield from update_bids_layout(ds, rebuild=force)
 
         if drop:
             # None by default to serve as indicator whether we actually want to
@@ -319,28 +535,530 @@ class Update(Interface):
         if not merge:
             return
 
-        # and update active branch
-        repo.call_git(['checkout', initial_branch])
+        yield from merge_update(ds, initial_branch)
+
 
-        if initial_branch in ('incoming',
-                              'incoming-native',
-                              'incoming-bids'):
+def update_native_layout(ds, extract, prefetched=None, rebuild=False):
+    """Update incoming-native from the state of the incoming branch
+
+    Only records whose download changed since the last update are
+    processed, unless `rebuild` is set, or the archive member filters in
+    the dataset configuration changed. Archives are registered from their
+    manifest, if it covers all selected files, and are extracted otherwise.
+
+    Parameters
+    ----------
+    ds : Dataset
+    extract : callable
+      Called with the path of an archive, must return a future of the
+      extraction, see `submit_extraction()`.
+    prefetched : dict, optional
+      Futures of extractions started alongside the download, with the
+      archive file name as key.
+    rebuild : bool
+      Process all records of the incoming branch.
+    """
+    repo = ds.repo
+    prefetched = prefetched or {}
+    filters = get_member_filters(ds)
+    subid = _get_participant(repo)
+    built_filters = _get_built_member_filters(repo)
+    if built_filters is None:
+        # first build of the native layout
+        rebuild = True
+    elif filters != built_filters:
+        lgr.info('Archive member filters changed, processing all records')
+        rebuild = True
+    initial_native = repo.get_hexsha('incoming-native')
+    native_entries = get_tree_entries(repo, 'incoming-native')
+    # the state of incoming the native layout was last built from
+    built_incoming = repo.call_git_oneline(
+        ['merge-base', 'incoming-native', 'incoming'])
+
+    # only records whose download changed need to be processed
+    previous = _get_incoming_records(repo, built_incoming)
+    current = _get_incoming_records(repo, 'incoming')
+    changed = {
+        fp: props for fp, props in current.items()
+        if rebuild
+        or previous.get(fp, {}).get('gitshasum') != props['gitshasum']
+    }
+    lgr.info(
+        'Processing %i new or changed record(s), keeping %i, '
+        'removing %i',
+        len(changed), len(current) - len(changed),
+        len(set(previous) - set(current)))
+    # wipe out the native content of changed and vanished records
+    outdated = set(
+        _get_native_name(fp)
+        for fp in set(changed).union(set(previous) - set(current)))
+    for path in list(native_entries):
+        if PurePosixPath(path).parts[0] in outdated:
+            del native_entries[path]
+
+    extractions = []
+    manifests = {}
+    links = []
+    for fp, props in changed.items():
+        # we have to extract into per-instance directories, otherwise files
+        # would conflict
+        native_name = _get_native_name(fp)
+        select = _get_member_selector(filters, subid, fp)
+
+        members = read_manifest(repo, props['key']) \
+            if fp.suffix == '.zip' else None
+        if members is not None:
+            manifests[props['key']] = members
+        if members is not None and not any(
+                m['key'] is None and (select is None or select(m['path']))
+                for m in members):
+            # this archive was ingested before, no need to open it
+            extraction = Future()
+            extraction.set_result(
+                dict(size=props['bytesize'], members=members))
+            extractions.append(
+                (props['key'], native_name, extraction, select))
+        elif fp.suffix == '.zip':
+            extraction = prefetched.get(fp.name)
+            if extraction is None or extraction.exception() \
+                    or extraction.result()['size'] != props['bytesize']:
+                # not extracted alongside the download, or not from
+                # the downloaded file that has been annexed
+                extraction = extract(
+                    _get_key_content(repo, props['key']), select=select)
+            extractions.append(
+                (props['key'], native_name, extraction, select))
+        elif 'key' in props:
+            # move into instance dir, and strip participant ID, and instance ID
+            # but keep array index
+            # e.g. -> 25747_3_0.adv -> instance-3/25747_0
+            links.append((props['key'], native_name))
+        else:
+            # not annexed, according to annex.largefiles
+            native_entries[native_name] = (MODE_FILE, props['gitshasum'])
+
+    archives = []
+    for key, rec_id, extraction, select in extractions:
+        members = extraction.result()['members']
+        if members is not manifests.get(key):
+            # keep the keys of files ingested before, but not this time
+            known = {
+                m['path']: m['key'] for m in manifests.get(key, [])
+                if m['key'] is not None}
+            for m in members:
+                if m['key'] is None:
+                    m['key'] = known.get(m['path'])
+            write_manifest(repo, key, members)
+        archives.append((key, rec_id, [
+            m for m in members
+            if m['key'] is not None
+            and (select is None or select(m['path']))]))
+    # single registration step for the content of all archives
+    for r in register_archive_content(repo, archives):
+        yield dict(r, logger=lgr, refds=ds.path)
+
+    links.extend(
+        (m['key'], '{}/{}'.format(rec_id, m['path']))
+        for _, rec_id, members in archives
+        for m in members)
+    add_annex_links(repo, native_entries, links)
+    tree = write_tree(repo, native_entries)
+    # mark the incoming change as merged
+    # (but we do not actually want any branch content)
+    merged = repo.call_git_success(
+        ['merge-base', '--is-ancestor', 'incoming', 'incoming-native'])
+    if not merged or tree != get_tree(repo, initial_native):
+        update_branch(
+            repo, 'incoming-native',
+            commit_tree(
+                repo, tree,
+                [initial_native]
+                + ([] if merged else [repo.get_hexsha('incoming')]),
+                "Update native layout{}".format(
+                    '\n\nMember-filter: {}\n'.format(
+                        json.dumps(filters, sort_keys=True))
+                    if filters != NO_MEMBER_FILTERS else '')),
+            initial_native)
+
+
+def plan_bids_layout(ds, rebuild=False):
+    """Plan an update of incoming-bids from the state of incoming-native
+
+    Nothing is changed. Only paths that changed in incoming-native since the
+    last update are mapped, unless `rebuild` is set. Files that would
+    collide with another file at their BIDS path are kept at their native
+    path.
+
+    Parameters
+    ----------
+    ds : Dataset
+    rebuild : bool
+      Map all files of incoming-native.
+
+    Returns
+    -------
+    dict
+      'native': the incoming-native commit the plan is derived from.
+      'base': the incoming-bids commit to amend, or None if the BIDS
+      layout is derived from scratch.
+      'moves': incoming-native path of each file, with its path in the BIDS
+      layout as key.
+      'collisions': incoming-native paths of all files that collide at a
+      BIDS path, with that path as key. A single file collides with a file
+      that is kept in the BIDS layout.
+      'unmapped': incoming-native paths of data record files without a
+      BIDS mapping. They are kept at their native path.
+      'removed': paths to remove from the base layout.
+      'native_entries': the tree of incoming-native, see
+      `get_tree_entries()`.
+    """
+    repo = ds.repo
+    # the BIDS layout is derived from the latest state of
+    # incoming-native, but histories are kept separate (ie. no
+    # merge). instead, each update records the incoming-native
+    # commit it was derived from in its commit message
+    initial_bids = repo.get_hexsha('incoming-bids')
+    subid = _get_participant(repo)
+    native = repo.get_hexsha('incoming-native')
+    native_entries = get_tree_entries(repo, 'incoming-native')
+    # the state of incoming-native the BIDS layout was derived from.
+    # a rebuild remaps everything, in case the mapping changed
+    built_native = None if rebuild else _get_built_native(
+        repo, initial_bids)
+    if built_native:
+        # only remap what changed in the native layout, and
+        # leave the rest of the BIDS tree untouched
+        paths = get_changed_paths(repo, built_native, native)
+    else:
+        paths = native_entries
+    bids_paths = map_ukb2bids(paths, subid, 'non-bids')
+    # source paths of each target path
+    sources = {}
+    # target path of each removed source path
+    removed = {}
+    unmapped = []
+    for path in sorted(paths):
+        # anything that doesn't look like a UKB data record
+        # stays where it is
+        target = bids_paths.get(path, path)
+        if path not in native_entries:
+            removed[path] = target or path
+            continue
+        if target is None:
+            unmapped.append(path)
+            target = path
+        sources.setdefault(target, []).append(path)
+    added = set()
+    occupied = set()
+    if built_native:
+        previous = get_tree_entries(repo, built_native, paths=paths)
+        added = set(paths).difference(previous)
+        # files that collided before were kept at their native path,
+        # they leave it, unless they collide again
+        kept = set(get_tree_entries(
+            repo, initial_bids, paths=list(previous))) if previous else set()
+        removed = set(p if p in kept else t for p, t in removed.items())
+        removed.update(kept.intersection(native_entries))
+        # files new to the native layout must not replace a file that
+        # is kept in the BIDS layout
+        targets = [
+            t for t, srcs in sources.items() if added.intersection(srcs)]
+        if targets:
+            occupied = set(get_tree_entries(
+                repo, initial_bids, paths=targets)).difference(removed)
+    else:
+        removed = set(removed.values())
+    # source paths, with the target path as keys
+    moves = {}
+    collisions = {}
+    for target, srcs in sorted(sources.items()):
+        if len(srcs) > 1 or target in occupied and srcs[0] in added:
+            collisions[target] = srcs
+        else:
+            moves[target] = srcs[0]
+    # colliding files stay where they are
+    for srcs in collisions.values():
+        for src in srcs:
+            moves.setdefault(src, src)
+    return dict(
+        native=native,
+        base=initial_bids if built_native else None,
+        moves=moves,
+        collisions=collisions,
+        unmapped=unmapped,
+        removed=removed,
+        native_entries=native_entries,
+    )
+
+
+def update_bids_layout(ds, rebuild=False):
+    """Update incoming-bids from the state of incoming-native
+
+    The update is planned with `plan_bids_layout()`, and applied by
+    committing the resulting tree. Files without a BIDS mapping are
+    reported as impossible, and files that collide at their BIDS path as
+    errors.
+    """
+    repo = ds.repo
+    res = dict(
+        action='ukb_bidsify',
+        type='file',
+        logger=lgr,
+        refds=ds.path,
+    )
+    initial_bids = repo.get_hexsha('incoming-bids')
+    plan = plan_bids_layout(ds, rebuild=rebuild)
+    for path in plan['unmapped']:
+        yield dict(
+            res,
+            path=str(repo.pathobj / path),
+            status='impossible',
+            message='No BIDS file name mapping available',
+        )
+    for target, srcs in sorted(plan['collisions'].items()):
+        for src in srcs:
             yield dict(
                 res,
-                action='ukb_merge_update',
-                status='impossible',
-                message='Refuse to merge into incoming* branch',
+                path=str(repo.pathobj / src),
+                bids_path=str(repo.pathobj / target),
+                status='error',
+                message=('Multiple files map to BIDS path %s', target)
+                if len(srcs) > 1
+                else ('BIDS path %s exists already', target),
             )
-            return
+    collided = sum(len(srcs) for srcs in plan['collisions'].values())
+    lgr.info(
+        'Mapping %i file(s) to BIDS, '
+        'skipping %i colliding, removing %i',
+        len(plan['moves']) - collided, collided, len(plan['removed']))
+    bids_entries = move_entries(repo, plan['native_entries'], plan['moves'])
+    if plan['base']:
+        tree = write_tree(
+            repo, bids_entries, base=plan['base'],
+            removed=plan['removed'].difference(bids_entries))
+    else:
+        tree = write_tree(repo, bids_entries)
+    # mark the incoming change as merged
+    # (but we do not actually want any branch content)
+    merged = repo.call_git_success(
+        ['merge-base', '--is-ancestor', 'incoming', 'incoming-bids'])
+    if not merged or tree != get_tree(repo, initial_bids):
+        update_branch(
+            repo, 'incoming-bids',
+            commit_tree(
+                repo, tree,
+                [initial_bids]
+                + ([] if merged else [repo.get_hexsha('incoming')]),
+                "Update BIDS layout\n\nNative-layout: {}\n".format(
+                    plan['native'])),
+            initial_bids)
 
-        repo.call_git([
-            'merge',
-            '-m', "Merge update from UKbiobank",
-            'incoming-bids' if want_bids else 'incoming-native'])
 
+def merge_update(ds, initial_branch):
+    """Merge the most processed incoming branch into the active branch"""
+    repo = ds.repo
+    res = dict(
+        action='ukb_merge_update',
+        path=ds.path,
+        type='dataset',
+        logger=lgr,
+        refds=ds.path,
+    )
+    if initial_branch in ('incoming',
+                          'incoming-native',
+                          'incoming-bids'):
         yield dict(
             res,
-            action='ukb_merge_update',
-            status='ok',
+            status='impossible',
+            message='Refuse to merge into incoming* branch',
         )
         return
+
+    repo.call_git([
+        'merge',
+        '-m', "Merge update from UKbiobank",
+        'incoming-bids' if 'incoming-bids' in repo.get_branches()
+        else 'incoming-native'])
+
+    yield dict(
+        res,
+        status='ok',
+    )
+
+
+def _prefetch_archives(srcdir, stop, extract, extractions):
+    """Extract record archives while other downloads are still running
+
+    Any ZIP file appearing in `srcdir` is submitted for extraction, until
+    `stop` is set.
+
+    Parameters
+    ----------
+    srcdir : Path
+    stop : threading.Event
+    extract : callable
+      Called with the path of an archive, must return a future of the
+      extraction.
+    extractions : dict
+      Futures are stored in here, with the archive name as key.
+    """
+    while True:
+        # one last sweep after the download finished
+        last_round = stop.is_set()
+        for fp in sorted(srcdir.glob('[0-9]*_[0-9]*_[0-9]_[0-9].zip')):
+            if fp.name in extractions:
+                continue
+            extractions[fp.name] = extract(fp)
+        if last_round:
+            return
+        stop.wait(1)
+
+
+def submit_extraction(pool, objdir, backend, archive, select=None):
+    return pool.submit(
+        ingest_archive, str(archive), objdir, backend, select=select)
+
+
+def _get_built_member_filters(repo):
+    """Return the archive member filters of the last native layout update
+
+    Returns
+    -------
+    dict or None
+      See `get_member_filters()`, or None if the native layout was never
+      updated.
+    """
+    msg = repo.call_git(
+        ['log', '-1', '--first-parent', '--grep=^Update native layout',
+         '--format=%B', 'incoming-native'],
+        read_only=True)
+    if not msg:
+        return None
+    match = re.search(r'^Member-filter: (.*)$', msg, re.MULTILINE)
+    if match is None:
+        # an update without filters
+        return dict(NO_MEMBER_FILTERS)
+    return dict(NO_MEMBER_FILTERS, **json.loads(match.group(1)))
+
+
+def _get_member_selector(filters, subid, fp):
+    """Return a predicate selecting the files of a record archive
+
+    Parameters
+    ----------
+    filters : dict
+      See `get_member_filters()`.
+    subid : str
+      Participant ID
+    fp : Path
+      Name of the record archive.
+
+    Returns
+    -------
+    callable or None
+      See `get_member_filter()`.
+    """
+    select = get_member_filter(filters['include'], filters['exclude'])
+    if not filters['bids_only']:
+        return select
+    native_name = _get_native_name(fp)
+
+    def select_bids(path):
+        # without a directory for unrecognized files, only files with a
+        # genuine BIDS name are mapped
+        return (select is None or select(path)) and get_bids_path(
+            '{}/{}'.format(native_name, path), subid, None) is not None
+    return select_bids
+
+
+def _get_participant(repo):
+    """Return the participant ID from the batch file on the incoming branch"""
+    return list(repo.call_git_items_(
+        ["cat-file", "-p", "incoming:.ukbbatch"])
+    )[0].split(maxsplit=1)[0]
+
+
+def _is_record_file(name):
+    """Whether a file name is that of a data record download"""
+    return fnmatch(name, '[0-9]*_[0-9]*_[0-9]_[0-9].*') and '/' not in name
+
+
+def _format_run_message(ds, cmd, outputs, message):
+    """Compose a commit message with a `datalad run` record"""
+    record = dict(
+        chain=[],
+        cmd=cmd,
+        dsid=ds.id,
+        exit=0,
+        extra_inputs=[],
+        inputs=[],
+        outputs=outputs,
+        pwd='.',
+    )
+    return """\
+[DATALAD RUNCMD] {}
+
+=== Do not change lines below ===
+{}
+^^^ Do not change lines above ^^^
+""".format(
+        message,
+        json.dumps(record, indent=1, sort_keys=True, ensure_ascii=False))
+
+
+def _get_incoming_records(repo, ref):
+    """Return annex properties of all downloaded records in a commit"""
+    return {
+        fp: props
+        for fp, props in repo.get_content_annexinfo(
+            ref=ref, eval_availability=False).items()
+        # skip internals
+        if not fp.name.startswith(('.git', '.datalad', '.ukb'))
+    }
+
+
+def _get_built_native(repo, commit):
+    """Return the incoming-native commit a BIDS layout was last built from
+
+    Only the most recent BIDS layout update in the first-parent history of
+    `commit` is considered. Commits made since, e.g. by `ukb-init`, are
+    mirrored on incoming-native.
+
+    Returns None if no update records it, or if the recorded commit is not
+    available.
+    """
+    match = re.search(
+        r'^Native-layout: ([0-9a-f]+)$',
+        repo.call_git(
+            ['log', '-1', '--first-parent', '--grep=^Native-layout: ',
+             '--format=%B', commit],
+            read_only=True),
+        re.MULTILINE)
+    if match is None or not repo.call_git_success(
+            ['cat-file', '-e', '{}^{{commit}}'.format(match.group(1))],
+            read_only=True):
+        return None
+    return match.group(1)
+
+
+def _get_native_name(fp):
+    """Return the name of a record's content in the native layout
+
+    This is the directory an archive is extracted into, or the file name of
+    any other record.
+    """
+    ids = fp.stem.split('_')
+    if not len(ids) >= 3:
+        raise RuntimeError('Unrecognized filename structure: {}'.format(fp))
+    # build an ID from the data record and the array index
+    rec_id = '_'.join(ids[1:])
+    return rec_id if fp.suffix == '.zip' else rec_id + ''.join(fp.suffixes)
+
+
+def _get_key_content(repo, key):
+    """Return the path of a key's content, obtain it first if needed"""
+    objpath = repo.get_contentlocation(key)
+    if not objpath:
+        repo.call_annex(['get', '--key', key])
+        objpath = repo.get_contentlocation(key)
+    return repo.pathobj / objpath
@@ -0,0 +1,441 @@
+# emacs: -*- mode: python; py-indent-offset: 4; tab-width: 4; indent-tabs-mode: nil -*-
+# ex: set sts=4 ts=4 sw=4 noet:
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+#
+#   See COPYING file distributed along with the datalad package for the
+#   copyright and license terms.
+#
+# ## ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ### ##
+"""
+
+"""
+
+import json
+import logging
+import os
+import shutil
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    as_completed,
+)
+
+from datalad.interface.base import Interface
+from datalad.interface.base import eval_results
+from datalad.interface.base import build_doc
+from datalad.support.constraints import (
+    EnsureChoice,
+    EnsureInt,
+    EnsureRange,
+    EnsureStr,
+    EnsureNone,
+)
+from datalad.support.gitrepo import GitRepo
+from datalad.support.param import Parameter
+from datalad.utils import Path
+
+from datalad.distribution.dataset import (
+    datasetmethod,
+    EnsureDataset,
+    require_dataset,
+)
+
+from datalad_ukbiobank.cache import (
+    add_cached_record,
+    has_cached_record,
+)
+from datalad_ukbiobank.fetch import (
+    fetch_batch,
+    parse_batch,
+)
+from datalad_ukbiobank.init_bulk import get_process_pool
+from datalad_ukbiobank.plumbing import ensure_local_branch
+from datalad_ukbiobank.update import Update
+
+
+__docformat__ = 'restructuredtext'
+
+lgr = logging.getLogger('datalad.ukbiobank.update_all')
+
+# maximum number of lines ukbfetch accepts in a batch file
+_ukbfetch_batch_limit = 1000
+
+
+@build_doc
+class UpdateAll(Interface):
+    """Update all UKBiobank participant datasets of a superdataset
+
+    Any installed subdataset with a batch file on an 'incoming' branch is
+    updated with `ukb-update`, in parallel worker processes. This includes
+    subdatasets of a clone, which only have the branch of their origin.
+    Other subdatasets are reported, and ignored.
+
+    Each completed participant is recorded in a journal
+    (.git/datalad/ukb/update-all.journal in the superdataset). When an
+    interrupted run is repeated, participants recorded as done are skipped,
+    and only failed and outstanding ones are updated. The journal is removed
+    once all participants were updated successfully.
+
+    In cohort fetch mode, the data records of all participants are
+    downloaded up front, with a few `ukbfetch` processes for combined batch
+    files, instead of one `ukbfetch` process per participant. The downloads
+    are placed in the download cache configured for the superdataset
+    (datalad.ukbiobank.cache), or, if none is configured, in a temporary
+    download cache in the superdataset (.git/tmp/ukb/cohort). Each
+    `ukb-update` then takes the files of its participant from this cache.
+    Run records are unaffected, they still reference each participant's
+    own download.
+
+    On platforms without fork() (e.g. Windows), worker processes are
+    spawned, and re-import the main module. Python scripts must then call
+    this command under an ``if __name__ == '__main__':`` guard.
+    """
+
+    _params_ = dict(
+        dataset=Parameter(
+            args=("-d", "--dataset"),
+            metavar='DATASET',
+            doc="""specify the superdataset to update the participant
+            datasets of""",
+            constraints=EnsureDataset() | EnsureNone()),
+        keyfile=Parameter(
+            args=('-k', '--keyfile',),
+            metavar='PATH',
+            doc="""path to a file with an authentification key
+            (ukbfetch -a ...). If none is given, the configuration
+            datalad.ukbiobank.keyfile of each participant dataset is
+            consulted.""",
+            constraints=EnsureStr() | EnsureNone()),
+        merge=Parameter(
+            args=('--merge',),
+            action='store_true',
+            doc="""merge any updates into the active branch of each
+            participant dataset, see ukb-update."""),
+        force=Parameter(
+            args=('-f', '--force',),
+            action='store_true',
+            doc="""update the incoming branch(es), even if (re-)download
+            did not yield changed content, see ukb-update."""),
+        drop=Parameter(
+            args=('--drop',),
+            doc="""drop file content to avoid storage duplication, see
+            ukb-update.""",
+            constraints=EnsureChoice(None, 'extracted', 'archives')),
+        incremental=Parameter(
+            args=('--incremental',),
+            action='store_true',
+            doc="""only download data records that are not yet present,
+            see ukb-update."""),
+        jobs=Parameter(
+            args=('-J', '--jobs'),
+            metavar='N',
+            doc="""update up to N participant datasets in parallel. Mind
+            that UKB limits the number of concurrent downloads of an
+            application.""",
+            constraints=EnsureInt() & EnsureRange(min=1) | EnsureNone()),
+        restart=Parameter(
+            args=('--restart',),
+            action='store_true',
+            doc="""ignore the journal of an interrupted run, and update all
+            participant datasets."""),
+        cohort_fetch=Parameter(
+            args=('--cohort-fetch',),
+            action='store_true',
+            doc="""download the data records of all participants with
+            combined batch files, before the participant datasets are
+            updated. --jobs then also sets the number of concurrent
+            'ukbfetch' processes."""),
+        recursive=Parameter(
+            args=('-r', '--recursive',),
+            action='store_true',
+            doc="""also consider subdatasets of subdatasets."""),
+    )
+    @staticmethod
+    @datasetmethod(name='ukb_update_all')
+    @eval_results
+    def __call__(keyfile=None, merge=False, force=False, drop=None,
+                 incremental=False, jobs=None, restart=False,
+                 cohort_fetch=False, recursive=False, dataset=None):
+        ds = require_dataset(
+            dataset, check_installed=True, purpose='update')
+
+        res = dict(
+            action='ukb_update_all',
+            path=ds.path,
+            type='dataset',
+            logger=lgr,
+            refds=ds.path,
+        )
+
+        update_kwargs = dict(
+            # participant datasets resolve relative paths against their root
+            keyfile=str(Path(keyfile).absolute()) if keyfile else None,
+            merge=merge,
+            force=force,
+            drop=drop,
+            incremental=incremental,
+        )
+
+        journal = ds.repo.dot_git / 'datalad' / 'ukb' / 'update-all.journal'
+        if restart and journal.exists():
+            journal.unlink()
+        done = read_journal(journal)
+        if done:
+            lgr.info('Resuming interrupted run, skipping %i participant '
+                     'dataset(s) already updated', len(done))
+
+        subdatasets = [
+            sds['path'] for sds in ds.subdatasets(
+                state='present',
+                recursive=recursive,
+                result_renderer='disabled',
+                return_type='generator')
+            if sds['path'] not in done
+        ]
+        ignored = [p for p in subdatasets if not _is_participant_dataset(p)]
+        for path in ignored:
+            yield dict(
+                res,
+                path=path,
+                status='notneeded',
+                message='Not a UKB participant dataset',
+            )
+        subdatasets = [p for p in subdatasets if p not in ignored]
+        env = {}
+        staging = ds.repo.dot_git / 'tmp' / 'ukb' / 'cohort'
+        if cohort_fetch and subdatasets:
+            keyfile = update_kwargs['keyfile'] or str(Path(ds.config.obtain(
+                'datalad.ukbiobank.keyfile',
+                dialog_type='question',
+                title='Key file location',
+                text='Where is the location of the file with the UKB '
+                     'access key?',
+            )).absolute())
+            # a configured cache is populated, such that it also serves
+            # later updates. leftovers of an interrupted run are still
+            # valid, and are not downloaded again
+            cachedir = Path(
+                ds.config.get('datalad.ukbiobank.cache')
+                or staging / 'cache').absolute()
+            yield dict(
+                res,
+                action='ukb_cohort_fetch',
+                **_fetch_cohort(
+                    subdatasets, staging, cachedir, keyfile, jobs or 1,
+                    incremental))
+            env['DATALAD_UKBIOBANK_CACHE'] = str(cachedir)
+
+        counts = dict(ok=0, notneeded=0, error=0)
+        journal.parent.mkdir(parents=True, exist_ok=True)
+        with get_process_pool(jobs) as pool, \
+                open(str(journal), 'a') as jf:
+            futures = {
+                pool.submit(
+                    _update_participant, path, update_kwargs, env): path
+                for path in subdatasets
+            }
+            for f in as_completed(futures):
+                path = futures[f]
+                results = f.result()
+                status = _get_participant_status(results)
+                counts[status] += 1
+                for r in results:
+                    yield dict(r, logger=lgr, refds=ds.path)
+                # record progress immediately, the run might get killed
+                jf.write('{}\n'.format(json.dumps(
+                    dict(path=path, status=status))))
+                jf.flush()
+                os.fsync(jf.fileno())
+
+        failed = counts['error']
+        if not failed:
+            journal.unlink()
+            shutil.rmtree(str(staging), ignore_errors=True)
+        yield dict(
+            res,
+            status='error' if failed else 'ok',
+            message=(
+                '%i participant dataset(s) updated, %i unchanged, '
+                '%i failed, %i skipped as done before, %i other dataset(s) '
+                'ignored',
+                counts['ok'], counts['notneeded'], failed, len(done),
+                len(ignored)),
+            counts=dict(counts, skipped=len(done), ignored=len(ignored)),
+        )
+
+
+def read_journal(path):
+    """Return the participant datasets a journal records as done
+
+    Returns
+    -------
+    set
+      Paths of all datasets that were updated successfully.
+    """
+    done = set()
+    if not Path(path).exists():
+        return done
+    with open(str(path)) as f:
+        for line in f:
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                # the last line of a killed run can be incomplete
+                continue
+            if rec['status'] == 'error':
+                done.discard(rec['path'])
+            else:
+                done.add(rec['path'])
+    return done
+
+
+def _fetch_cohort(subdatasets, staging, cachedir, keyfile, jobs,
+                  incremental):
+    """Download the data records of many participants with combined batches
+
+    Parameters
+    ----------
+    subdatasets : list
+      Paths of participant datasets.
+    staging : Path
+      Directory to stage the downloads in.
+    cachedir : Path
+      Download cache to place the downloads in.
+    keyfile : str
+      Absolute path of the authentication key file.
+    jobs : int
+      Number of concurrent ukbfetch processes.
+    incremental : bool
+      Only download records that are not yet on the incoming branch of a
+      participant dataset.
+
+    Returns
+    -------
+    dict
+      Status and message of a result record.
+    """
+    batch = []
+    for path in subdatasets:
+        repo = GitRepo(path)
+        present = set(
+            name.split('.', 1)[0]
+            for name in repo.call_git_items_(
+                ['ls-tree', '--name-only', 'incoming'], read_only=True)
+        ) if incremental else set()
+        batch.extend(
+            (p, r)
+            for p, r in parse_batch(
+                repo.call_git(
+                    ['cat-file', '-p', 'incoming:.ukbbatch'],
+                    read_only=True),
+                source='batch file of {}'.format(path))
+            if '{}_{}'.format(p, r) not in present)
+
+    # records cached before, e.g. by an interrupted run, are not downloaded
+    # again
+    cached = [
+        (p, r) for p, r in batch
+        if has_cached_record(cachedir, '{}_{}'.format(p, r))]
+    batch = [rec for rec in batch if rec not in cached]
+
+    downloaddir = staging / 'download'
+    for d in (downloaddir, cachedir):
+        d.mkdir(parents=True, exist_ok=True)
+    chunks = [
+        batch[i:i + _ukbfetch_batch_limit]
+        for i in range(0, len(batch), _ukbfetch_batch_limit)]
+    lgr.info('Downloading %i data record(s) with %i batch(es), '
+             '%i cached already', len(batch), len(chunks), len(cached))
+    failed = 0
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [
+            pool.submit(
+                fetch_batch, chunk, 'cohort{}'.format(i), keyfile,
+                staging, downloaddir, True)
+            for i, chunk in enumerate(chunks)
+        ]
+        for f in futures:
+            ret, _ = f.result()
+            if ret:
+                failed += 1
+    # hand over to the participant datasets via the download cache
+    fetched = {}
+    for fp in sorted(downloaddir.iterdir()):
+        fetched.setdefault(fp.name.split('.', 1)[0], []).append(fp)
+    for rec, paths in fetched.items():
+        add_cached_record(cachedir, rec, paths)
+        for fp in paths:
+            fp.unlink()
+    if failed:
+        return dict(
+            status='error',
+            message=(
+                '%i of %i ukbfetch batch(es) failed, logs are in %s. '
+                'Missing records are downloaded by each participant update',
+                failed, len(chunks), staging),
+        )
+    return dict(
+        status='ok',
+        message=('Downloaded %i of %i data record(s), %i cached already',
+                 len(fetched), len(batch), len(cached)),
+    )
+
+
+def _is_participant_dataset(path):
+    """Return whether a dataset has a batch file on an incoming branch
+
+    In a clone, the local incoming branch is created from the remote one.
+    """
+    repo = GitRepo(path)
+    ensure_local_branch(repo, 'incoming')
+    return repo.call_git_success(
+        ['rev-parse', '--verify', '-q', 'incoming:.ukbbatch'],
+        read_only=True)
+
+
+def _update_participant(path, update_kwargs, env=None):
+    """Update a participant dataset, in a worker process
+
+    Parameters
+    ----------
+    path : str
+    update_kwargs : dict
+      Arguments of `ukb-update`.
+    env : dict, optional
+      Environment variables to set, e.g. to configure a download cache.
+
+    Returns
+    -------
+    list
+      Result records.
+    """
+    os.environ.update(env or {})
+    try:
+        return [
+            {k: v for k, v in r.items() if k != 'logger'}
+            for r in Update.__call__(
+                dataset=path,
+                result_renderer='disabled',
+                return_type='list',
+                on_failure='ignore',
+                **update_kwargs)
+        ]
+    except Exception as e:
+        return [dict(
+            action='ukb_update',
+            path=path,
+            type='dataset',
+            status='error',
+            message=('Failed to update dataset: %s', str(e)),
+        )]
+
+
+def _get_participant_status(results):
+    """Condense the results of a participant's update into a single status"""
+    if any(r['status'] in ('error', 'impossible')
+           and r['action'] != 'ukb_bidsify'
+           for r in results):
+        return 'error'
+    if any(r['status'] == 'ok' and r['action'] == 'ukb_update'
+           for r in results):
+        return 'ok'
+    return 'notneeded'
@@ -26,5 +26,8 @@ if __name__ == '__main__':
               'datalad.extensions': [
                   'ukbiobank=datalad_ukbiobank:command_suite',
               ],
+              'console_scripts': [
+                  'ukbfetch-sharded=datalad_ukbiobank.fetch:main',
+              ],
           },
     )